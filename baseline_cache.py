@@ -0,0 +1,67 @@
+"""An on-disk cache of the random baselines that stems are compared against.
+
+The baseline statistics of a set of random points only depend on the shape
+and size of the plane and the number of points, so they are worked out once
+for each (shape, size, count) and kept in a small JSON file shared by every
+analysis run. The least recently used entries are evicted once there are more
+than `max_entries` of them.
+"""
+
+
+import json
+import os
+
+import util
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class BaselineCache():
+    """Cache of baseline statistics in the JSON file `file_name`."""
+
+    def __init__(self, file_name, max_entries=DEFAULT_MAX_ENTRIES):
+        self.file_name = file_name
+        self.max_entries = max_entries
+
+    def get(self, shape, count, compute, size=util.DEFAULT_PLANE_SIZE):
+        """Return the cached baseline for `count` points in `shape` of the
+        (width, height) `size`, calling `compute(shape, count, size)` to work
+        it out if it isn't cached yet."""
+        key = '{}_{}'.format(shape, count)
+        # Planes of the default size keep the keys they always had.
+        if tuple(size) != tuple(util.DEFAULT_PLANE_SIZE):
+            key += '_{}x{}'.format(*size)
+        # Other processes may have added entries since we last looked.
+        entries = self._load()
+        if key in entries:
+            was_newest = next(reversed(entries)) == key
+            baseline = entries.pop(key)
+        else:
+            baseline = compute(shape, count, size)
+            was_newest = False
+
+        # Entries are kept from least to most recently used.
+        entries[key] = baseline
+        while len(entries) > self.max_entries:
+            del entries[next(iter(entries))]
+        if not was_newest:
+            self._save(entries)
+        return baseline
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'r') as cache_file:
+                return json.loads(cache_file.read())
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        # Write atomically since many workers may share the cache.
+        temp_file_name = '{}.{}.tmp'.format(self.file_name, os.getpid())
+        with open(temp_file_name, 'w') as cache_file:
+            cache_file.write(json.dumps(entries))
+        os.replace(temp_file_name, self.file_name)
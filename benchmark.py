@@ -0,0 +1,279 @@
+"""Benchmarks of the simulation and analysis hot paths.
+
+Each run appends one JSON object to the output file (bench_output.txt by
+default) with the commit it was run on, so results from different commits
+can be compared line by line. Every benchmark is seeded, and each time
+reported is the best of a few repeats.
+"""
+
+
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.stats
+
+import data_collector
+import lazy_melt
+import plane_v1
+import stat_v1
+import stem_index
+import stem_io
+import util
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+DEFAULT_OUTPUT_FILE_NAME = 'bench_output.txt'
+
+# Number of times each benchmark is repeated, keeping the best time.
+REPEATS = 3
+
+# (DROP_COUNT, DROP_RADIUS) pairs to measure simulation throughput at.
+SIMULATION_POINTS = [(20000, 0.03), (20000, 0.01), (100000, 0.01),
+                     (100000, 0.005)]
+# Numbers of stems to measure melting, index searches and analysis at.
+STEM_COUNTS = [1000, 10000, 100000]
+# Number of searches made of each index.
+SEARCH_COUNT = 20000
+# Numbers of stems on the large planes, which grow to hold them all at
+# LARGE_PLANE_DENSITY stems per unit area, and the drops landed on each.
+LARGE_PLANE_STEM_COUNTS = [10000, 1000000]
+LARGE_PLANE_DENSITY = 2500
+LARGE_PLANE_DROP_COUNT = 100000
+# Numbers of workers to compare parallel runs with serial ones at, the
+# seeds both are run with, and the settings they share.
+PARALLEL_WORKER_COUNTS = [2, 4]
+PARALLEL_SEED_COUNT = 8
+PARALLEL_SETTINGS = {'DROP_COUNT': 10000, 'MELT_PROBABILITY': 0.002}
+
+
+def _main():
+    args = sys.argv[1:]
+    quick = '--quick' in args
+    if quick:
+        args.remove('--quick')
+    if len(args) > 1 or '--help' in args:
+        alert_bad_usage_and_abort()
+    output_file_name = args[0] if args else DEFAULT_OUTPUT_FILE_NAME
+
+    results = run_benchmarks(quick)
+    with open(output_file_name, 'a') as output_file:
+        output_file.write(json.dumps(results) + '\n')
+    print(json.dumps(results, indent=2))
+
+
+def alert_bad_usage_and_abort():
+    print('usage: {} [output_file_name] [--quick]'.format(sys.argv[0]),
+          file=sys.stderr)
+    exit(1)
+
+
+def run_benchmarks(quick=False):
+    """Return a dict of the results of every benchmark. If `quick`, only the
+    smallest sizes are run."""
+    simulation_points = SIMULATION_POINTS[:2] if quick else SIMULATION_POINTS
+    stem_counts = STEM_COUNTS[:2] if quick else STEM_COUNTS
+    large_plane_stem_counts = (LARGE_PLANE_STEM_COUNTS[:1] if quick
+                               else LARGE_PLANE_STEM_COUNTS)
+    worker_counts = (PARALLEL_WORKER_COUNTS[:1] if quick
+                     else PARALLEL_WORKER_COUNTS)
+    return {
+        'commit': _current_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'quick': quick,
+        'simulation': [benchmark_simulation(drop_count, drop_radius)
+                       for drop_count, drop_radius in simulation_points],
+        'large_plane': [benchmark_large_plane(stem_count)
+                        for stem_count in large_plane_stem_counts],
+        'parallel': benchmark_parallel(worker_counts),
+        'melt': [benchmark_melt(stem_count) for stem_count in stem_counts],
+        'index_search': [benchmark_index_search(kind, stem_count)
+                         for kind in (stem_index.GRID, stem_index.KDTREE)
+                         for stem_count in stem_counts],
+        'analysis': [benchmark_analysis(stem_count)
+                     for stem_count in stem_counts]
+    }
+
+
+def _current_commit():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       cwd=directory).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _best_time(function, repeats=REPEATS):
+    """Return the shortest time `function()` took over `repeats` calls."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _settings(**overrides):
+    settings = dict(data_collector.SETTINGS, RANDOM_SEED=0)
+    settings.update(overrides)
+    return settings
+
+
+def _state_with_stems(settings, stem_count, death_step=0):
+    """Return a new state with `stem_count` random stems of random heights,
+    which melt away lazily on `death_step`."""
+    state = plane_v1.create_state(settings)
+    coords = state['rng'].coords(stem_count)
+    heights = np.floor(state['rng'].generator.uniform(0, 1000, stem_count))
+    plane_v1.load_stems(state, {
+        'x': coords[:, 0],
+        'y': coords[:, 1],
+        'height': heights,
+        'height_step': np.zeros(stem_count, dtype=np.int64),
+        'death_step': np.full(stem_count, death_step, dtype=np.int64)
+    })
+    return state
+
+
+def benchmark_simulation(drop_count, drop_radius):
+    """Measure how many drops per second simulate_step() gets through."""
+    settings = _settings(DROP_COUNT=drop_count, DROP_RADIUS=drop_radius,
+                         STEM_RADIUS=drop_radius,
+                         BOUNCE_DISTANCE=5 * drop_radius)
+
+    def simulate():
+        state = plane_v1.create_state(settings)
+        plane_v1.simulate_step(state, drop_count)
+
+    seconds = _best_time(simulate, 1)
+    return {'drop_count': drop_count, 'drop_radius': drop_radius,
+            'seconds': seconds, 'drops_per_second': drop_count / seconds}
+
+
+def benchmark_large_plane(stem_count):
+    """Measure how many drops per second simulate_step() gets through on a
+    square plane holding `stem_count` stems at LARGE_PLANE_DENSITY, so any
+    slowdown is down to the number of stems alone. The stems never melt."""
+    side = math.sqrt(stem_count / LARGE_PLANE_DENSITY)
+    settings = _settings(PLANE_SHAPE=util.SQUARE, PLANE_WIDTH=side,
+                         PLANE_HEIGHT=side, DROP_RADIUS=0.005,
+                         STEM_RADIUS=0.005, BOUNCE_DISTANCE=0.025,
+                         MELT_MODE=plane_v1.MELT_LAZY, MELT_PROBABILITY=0)
+    state = _state_with_stems(settings, stem_count, lazy_melt.NEVER)
+
+    start = time.perf_counter()
+    plane_v1.simulate_step(state, LARGE_PLANE_DROP_COUNT)
+    seconds = time.perf_counter() - start
+    return {'stem_count': stem_count, 'side': side, 'seconds': seconds,
+            'drops_per_second': LARGE_PLANE_DROP_COUNT / seconds}
+
+
+def benchmark_parallel(worker_counts):
+    """Measure parallel runs with each of `worker_counts` workers against
+    serial runs, both of PARALLEL_SETTINGS and PARALLEL_SEED_COUNT seeds.
+    The two draw different random numbers, so they are compared by what
+    they end up with: the stem count and the distribution of heights."""
+    results = [_parallel_result(1)]
+    serial_heights = results[0].pop('heights')
+    for worker_count in worker_counts:
+        result = _parallel_result(worker_count)
+        # Kolmogorov-Smirnov test of the heights against the serial ones.
+        ks = scipy.stats.ks_2samp(serial_heights, result.pop('heights'))
+        result.update(ks_statistic=ks.statistic, ks_p_value=ks.pvalue)
+        results.append(result)
+    return results
+
+
+def _parallel_result(worker_count):
+    stem_counts = []
+    heights = []
+    start = time.perf_counter()
+    for seed in range(PARALLEL_SEED_COUNT):
+        settings = _settings(RANDOM_SEED=seed, PARALLEL_WORKERS=worker_count,
+                             **PARALLEL_SETTINGS)
+        state = plane_v1.run_steps(plane_v1.create_state(settings),
+                                   settings['DROP_COUNT'])
+        _, stem_heights = plane_v1.collect_stems(state)
+        stem_counts.append(len(stem_heights))
+        heights.append(np.asarray(stem_heights, dtype=np.float64))
+    seconds = time.perf_counter() - start
+    heights = np.concatenate(heights)
+    return {'workers': worker_count, 'seconds': seconds,
+            'mean_stem_count': float(np.mean(stem_counts)),
+            'stem_count_std_error': float(np.std(stem_counts)
+                                          / math.sqrt(len(stem_counts))),
+            'mean_height': float(heights.mean()),
+            'height_std_dev': float(heights.std()),
+            'heights': heights}
+
+
+def benchmark_melt(stem_count):
+    """Measure a single melt() of `stem_count` stems."""
+    settings = _settings(MELT_PROBABILITY=0.0001)
+    states = [_state_with_stems(settings, stem_count) for _ in range(REPEATS)]
+
+    def melt():
+        plane_v1.melt(states.pop())
+
+    return {'stem_count': stem_count, 'seconds': _best_time(melt)}
+
+
+def benchmark_index_search(kind, stem_count):
+    """Measure SEARCH_COUNT searches of an index of kind `kind` holding
+    `stem_count` stems, at the interaction distance of the default settings."""
+    settings = _settings(STEM_INDEX=kind)
+    state = _state_with_stems(settings, stem_count)
+    geo = state['geo']
+    geo.rebalance()
+    radius = settings['DROP_RADIUS'] + settings['STEM_RADIUS']
+    rng = util.RandomStream(settings['PLANE_SHAPE'], 1,
+                            size=util.plane_size(settings))
+    coords = [tuple(coord) for coord in rng.coords(SEARCH_COUNT).tolist()]
+
+    def search():
+        for coord in coords:
+            geo.search(coord, radius)
+
+    seconds = _best_time(search)
+    return {'index': kind, 'stem_count': stem_count, 'searches': SEARCH_COUNT,
+            'seconds': seconds, 'searches_per_second': SEARCH_COUNT / seconds}
+
+
+def benchmark_analysis(stem_count):
+    """Measure stat_v1.public_main() on a file of `stem_count` stems of
+    equal height, so every one of them is part of the mesh. The baseline
+    cache is turned off so the random baseline is worked out every time."""
+    settings = _settings()
+    rng = util.RandomStream(settings['PLANE_SHAPE'], 2,
+                            size=util.plane_size(settings))
+    coords = rng.coords(stem_count)
+    heights = np.ones(stem_count)
+
+    cache_file_name = stat_v1.BASELINE_CACHE_FILE
+    stat_v1.BASELINE_CACHE_FILE = None
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            stems_file_name = os.path.join(
+                directory, 'bench' + stem_io.STEMS_EXTENSION)
+            output_file_name = os.path.join(directory, 'bench.json')
+            stem_io.write_stems(stems_file_name, settings, coords, heights)
+            seconds = _best_time(lambda: stat_v1.public_main(
+                stems_file_name, output_file_name))
+    finally:
+        stat_v1.BASELINE_CACHE_FILE = cache_file_name
+    return {'stem_count': stem_count, 'seconds': seconds}
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,62 @@
+"""Save and restore the full state of a simulation.
+
+A checkpoint is a single uncompressed .npz file holding the stem store's
+arrays and a JSON header with the settings, the step count and the state
+of the random stream. Everything else in a state (the spatial index, the
+melt queue) is rebuilt from the stems, so a resumed run carries on exactly
+as if it had never stopped.
+"""
+
+
+import json
+import os
+
+import numpy as np
+
+import stem_index
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+def save_checkpoint(state, file_name):
+    """Write `state` to `file_name`, replacing it atomically so a job that is
+    killed mid-write never leaves a broken checkpoint behind."""
+    header = {
+        'settings': state['settings'],
+        'steps_completed': state['steps_completed'],
+        'rng': state['rng'].get_state()
+    }
+    arrays = {'store_' + name: array
+              for name, array in state['store'].get_state().items()}
+
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'wb') as checkpoint_file:
+        np.savez(checkpoint_file, header=np.array(json.dumps(header)), **arrays)
+    os.replace(temp_file_name, file_name)
+
+
+def load_checkpoint(file_name, create_state, settings=None):
+    """Return the state saved in `file_name`, starting from the empty state
+    `create_state(settings)` returns. If `settings` is given it replaces the
+    saved settings, e.g. to raise DROP_COUNT and extend a finished run."""
+    with np.load(file_name) as checkpoint:
+        header = json.loads(str(checkpoint['header']))
+        store_state = {name[len('store_'):]: checkpoint[name]
+                       for name in checkpoint.files
+                       if name.startswith('store_')}
+
+    if settings is None:
+        settings = header['settings']
+    state = create_state(settings)
+    state['steps_completed'] = header['steps_completed']
+    state['rng'].set_state(header['rng'])
+
+    store = state['store']
+    store.set_state(store_state)
+    slots = store.live_slots()
+    coords = np.column_stack((store.x[slots], store.y[slots]))
+    state['geo'] = stem_index.build_index(settings, coords, slots)
+    if state['melter'] is not None:
+        state['melter'].rebuild_queue()
+    return state
@@ -2,25 +2,31 @@
 
 
 import json
-import numpy as np
 import os
 import os.path
-import subprocess
 import sys
 import util
 
 import stat_v1
+import stem_io
 
 
 PATH = 'collected_data/'
 
 
+# The metrics from stat_v1 that are averaged over the parts of a trial.
+METRICS = ('STEM_ANGLE_STD_DEV', 'RANDOM_ANGLE_STD_DEV', 'STEM_SIDE_STD_DEV',
+           'RANDOM_SIDE_STD_DEV', 'STEPS_COMPLETED')
+
+
 def _main():
     if not os.path.isdir(PATH):
         print('Data path not found: {}'.format(PATH))
         exit(1)
 
-    test_names = os.listdir(PATH)
+    # Streamed tests leave just their means behind as PATH/<test_name>.json.
+    test_names = [name for name in os.listdir(PATH)
+                  if os.path.isdir(PATH + name)]
     print('Found these tests:', ', '.join(test_names))
 
     tests = {}
@@ -33,62 +39,89 @@ def _main():
             if test_file_name == 'config':
                 continue
             trial, part = test_file_name.split('_')
-            assert part.endswith('.json')
-            part = part[:-5]
+            part, extension = os.path.splitext(part)
+            assert extension in ('.json', stem_io.STEMS_EXTENSION)
 
             if trial not in tests[test_name]:
                 tests[test_name][trial] = []
 
             tests[test_name][trial].append(test_dir_name + test_file_name)
 
-    output = {}
+    aggregate = Aggregate()
     for test_name in tests.keys():
-        output[test_name] = {}
-
         trials = tests[test_name]
         print(test_name)
         for trial in trials.keys():
-            output[test_name][trial] = {}
-
             file_names = trials[trial]
             #print(trial)
 
-            stem_angle_std_devs = []
-            random_angle_std_devs = []
-            stem_side_std_devs = []
-            random_side_std_devs = []
-
-            skip = False
             for file_name in file_names:
                 #print(file_name)
                 try:
-                    output_data_file_name = 'temp.json'
-                    stat_v1.public_main(file_name, output_data_file_name)
-                    with open(output_data_file_name) as output_file:
-                        data = json.loads(output_file.read())
-                    stem_angle_std_devs.append(data['STEM_ANGLE_STD_DEV'])
-                    random_angle_std_devs.append(data['RANDOM_ANGLE_STD_DEV'])
-                    stem_side_std_devs.append(data['STEM_SIDE_STD_DEV'])
-                    random_side_std_devs.append(data['RANDOM_SIDE_STD_DEV'])
+                    data = stem_io.read_stems(file_name, top_only=True)
+                    metrics = stat_v1.analyze_stems(data['settings'],
+                                                    data['coords'],
+                                                    data['heights'])
+                    # Runs that can stop early on convergence record how
+                    # long they ran.
+                    metrics['STEPS_COMPLETED'] = data.get(
+                        'steps_completed', data['settings']['DROP_COUNT'])
                 except:
                     # Not enough points to get data in all likelihood,
                     # since triangulation has a minimum.
                     print('Couldn\'t get data for', test_name, trial)
-                    # Skip the data for a trial if one part cannot be analysed.
-                    skip = True
+                    metrics = None
+                if not aggregate.add(test_name, trial, metrics):
                     break
 
-            if not skip:
-                a1 = np.mean(stem_angle_std_devs)
-                a2 = np.mean(random_angle_std_devs)
-                a3 = np.mean(stem_side_std_devs)
-                a4 = np.mean(random_side_std_devs)
-                output[test_name][trial]['STEM_ANGLE_STD_DEV'] = a1
-                output[test_name][trial]['RANDOM_ANGLE_STD_DEV'] = a2
-                output[test_name][trial]['STEM_SIDE_STD_DEV'] = a3
-                output[test_name][trial]['RANDOM_SIDE_STD_DEV'] = a4
-
-    print(json.dumps(output))
+    print(json.dumps(aggregate.output()))
+
+
+class Aggregate():
+    """Running means of the metrics of each trial over its parts, which can
+    be added one at a time in any order as they become available."""
+
+    def __init__(self):
+        # Map test name to a dict of trial to a dict of metric sums, or None
+        # for trials that had a part that couldn't be analysed.
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, test_name, trial, metrics):
+        """Add the metrics of one part of a trial, or None if it couldn't be
+        analysed. Return False if the trial is now being skipped."""
+        trial_sums = self.sums.setdefault(test_name, {})
+        trial_counts = self.counts.setdefault(test_name, {})
+        if trial not in trial_sums:
+            trial_sums[trial] = dict.fromkeys(METRICS, 0)
+            trial_counts[trial] = 0
+
+        # Skip the data for a trial if one part cannot be analysed.
+        if metrics is None:
+            trial_sums[trial] = None
+        if trial_sums[trial] is None:
+            return False
+
+        for metric in METRICS:
+            trial_sums[trial][metric] += metrics[metric]
+        trial_counts[trial] += 1
+        return True
+
+    def means(self, test_name, trial):
+        """Return a dict of the mean of each metric so far for a trial, which
+        is empty if the trial is being skipped."""
+        sums = self.sums[test_name][trial]
+        if sums is None:
+            return {}
+        count = self.counts[test_name][trial]
+        return {metric: sums[metric] / count for metric in METRICS}
+
+    def output(self):
+        """Return the means of every trial of every test, keyed by test name
+        and then trial."""
+        return {test_name: {trial: self.means(test_name, trial)
+                            for trial in trials}
+                for test_name, trials in self.sums.items()}
 
 
 if __name__ == "__main__":
@@ -1,23 +1,33 @@
 """Run a lot of simulations in parallel and collect data."""
 
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import json
 import os
 import os.path
-import subprocess
 import sys
+
+import plane_v1
+import stem_io
 import util
 
 
 PATH = 'collected_data/'
 
 
+# Trial outputs are written in the compact binary stems format.
+OUTPUT_EXTENSION = '.stems'
+
+
 SETTINGS = {
     "DROP_COUNT": 10000,
     "DROP_RADIUS": 0.03,
     "STEM_RADIUS": 0.03,
     "BOUNCE_DISTANCE": 0.15,
     "PLANE_SHAPE": util.DISK,
+    "PLANE_RADIUS": 1,
+    "PLANE_WIDTH": 2,
+    "PLANE_HEIGHT": 2,
     "MELT_PROBABILITY": 0.03,
     "GROUND_STICK_PROBABILITY": 0.05,
     "STEM_STICK_PROBABILITY": 1,
@@ -25,21 +35,47 @@ SETTINGS = {
     "INTERACTIVE_DELAY": 0.01,
     "INTERACTIVE_FAST_MODE": False,
     "INTERACTIVE_FAST_INTERVAL": 20000,
+    "ASYNC_DRAWING": True,
     "BOUNCE_HEIGHT_ADDITION": 20,
     "OLD_GENOME_BIAS": 40,
     "SHOW_BOUNCE_RADIUS": False,
     "MELT_INTERVAL": 30,
-    "PERIODIC_BOUNDARY": False
+    "MELT_MODE": "interval",
+    "PERIODIC_BOUNDARY": False,
+    "STEM_INDEX": "grid",
+    "RANDOM_SEED": None,
+    "PARALLEL_WORKERS": 1,
+    "PARALLEL_EPOCH_STEPS": None,
+    "CHECKPOINT_FILE": None,
+    "CHECKPOINT_INTERVAL": 100000,
+    "STATS_FILE": None,
+    "STATS_INTERVAL": 10000,
+    "STATS_HISTOGRAM_BINS": 20,
+    "PROFILE": False,
+    "FRAME_DIRECTORY": None,
+    "FRAME_INTERVAL": 10000,
+    "FRAME_SIZE": 1024,
+    "FRAME_FORMAT": "png",
+    "CONVERGENCE_WINDOW": 0,
+    "CONVERGENCE_TOLERANCE": 0.05
 }
 
 
-MAX_PROC_COUNT = 7
+# Number of simulations to run at once.
+POOL_SIZE = os.cpu_count()
+
+
+# Analyse each simulation as soon as it finishes, in its worker, and only
+# keep the metrics rather than writing every trial's stems to disk.
+STREAM_ANALYSIS = False
 
 
 def _main():
     if not os.path.isdir(PATH):
         os.mkdir(PATH)
 
+    run_test = run_test_streaming if STREAM_ANALYSIS else run_test_to_disk
+
     def vary_old_genom_bias(settings, trial_number):
         settings['OLD_GENOME_BIAS'] = 10 * trial_number
     run_test('Vary_OLD_GENOME_BIAS', 10, 5, vary_old_genom_bias)
@@ -62,7 +98,7 @@ def _main():
     run_test('Vary_BOUNCE_BONUS', 10, 5, vary_bounce_bonus)
 
 
-def run_test(test_name, trial_count, average_count, callback):
+def run_test_to_disk(test_name, trial_count, average_count, callback):
     print('Running test {}'.format(test_name))
     sys.stdout.flush()
 
@@ -75,60 +111,124 @@ def run_test(test_name, trial_count, average_count, callback):
     os.mkdir(dir_name)
     os.mkdir(config_dir_name)
 
-    # Run the test trials.
-    procs = []
-    for i in range(trial_count):
-        # Get the new trial settings.
-        callback(settings, i)
-
-        trial_name = '{}_trial_{}'.format(test_name, str(i).zfill(5))
-        trial_config_file_name = config_dir_name + str(i).zfill(5) + '.json'
-
-        # For each trial, save a config file.
-        with open(trial_config_file_name, 'w') as trial_config_file:
-            trial_config_file.write(json.dumps({'settings': settings}))
-
-        # Start the trial.
-        for j in range(average_count):
-            trial_part_output_file_name = dir_name + str(i).zfill(5) + '_' + str(j).zfill(2) + '.json'
-            schedule_process(['python', 'plane_v1.py', trial_config_file_name, trial_part_output_file_name],
-                             procs,
-                             i, j, test_name, trial_count, average_count)
-            print('> Running {} trial {}/{} part {}/{}'.format(test_name, i, trial_count - 1, j, average_count - 1))
+    # Run the test trials in a pool of worker processes, straight through
+    # plane_v1 rather than as a subprocess per trial part.
+    with ProcessPoolExecutor(max_workers=POOL_SIZE) as executor:
+        futures = {}
+        for i in range(trial_count):
+            # Get the new trial settings.
+            callback(settings, i)
+
+            # For each trial, save a config file for the record.
+            trial_config_file_name = config_dir_name + str(i).zfill(5) + '.json'
+            with open(trial_config_file_name, 'w') as trial_config_file:
+                trial_config_file.write(json.dumps({'settings': settings}))
+
+            # Start the trial.
+            for j in range(average_count):
+                trial_part_output_file_name = (dir_name + str(i).zfill(5) + '_'
+                                               + str(j).zfill(2)
+                                               + OUTPUT_EXTENSION)
+                part_settings = dict(settings)
+                if settings['RANDOM_SEED'] is not None:
+                    # Give every part its own reproducible stream.
+                    part_settings['RANDOM_SEED'] = [settings['RANDOM_SEED'],
+                                                    i, j]
+                future = executor.submit(run_trial_part, part_settings,
+                                         trial_part_output_file_name)
+                futures[future] = (i, j)
+                print('> Running {} trial {}/{} part {}/{}'.format(
+                    test_name, i, trial_count - 1, j, average_count - 1))
+                sys.stdout.flush()
+
+        # Report on the trial parts as they finish.
+        for future in as_completed(futures):
+            trial, part = futures[future]
+            stem_count, steps_completed = future.result()
+            print('< Done with {} trial {}/{} part {}/{} '
+                  '({} stems after {} steps)'.format(
+                      test_name, trial, trial_count - 1, part,
+                      average_count - 1, stem_count, steps_completed))
             sys.stdout.flush()
 
-    while procs:
-        assert len(procs) <= MAX_PROC_COUNT
-        wait_on_procs(procs, test_name, trial_count, average_count)
-
     print()
     sys.stdout.flush()
 
 
-def schedule_process(proc_args, procs, trial, part, test_name, trial_count, average_count):
-    """Wait until there are fewer than MAX_PROC_COUNT procs running then schedule another one."""
-    while len(procs) >= MAX_PROC_COUNT:
-        exited_proc = wait_on_procs(procs, test_name, trial_count, average_count)
+def run_test_streaming(test_name, trial_count, average_count, callback):
+    """Like run_test_to_disk() but analyse each trial part in its worker and
+    aggregate the metrics as they arrive, printing each trial's running
+    means. The final means are written to PATH/<test_name>.json."""
+    print('Running test {}'.format(test_name))
+    sys.stdout.flush()
+
+    # Only pull in the analysis code when we need it.
+    import data_aggregator
 
-    assert len(procs) <= MAX_PROC_COUNT
-    proc = subprocess.Popen(proc_args)
-    procs.append({'proc': proc, 'trial': trial, 'part': part})
+    # Copy the settings.
+    settings = dict(SETTINGS)
 
-    
-def wait_on_procs(procs, test_name, trial_count, average_count):
-    """Wait for a single proc to exit and return the one that did."""
-    while procs:
-        proc_data = procs.pop(0)
-        proc = proc_data['proc']
-        trial = proc_data['trial']
-        part = proc_data['part']
-        try:
-            proc.wait(0.5)
-            print('< Done with {} trial {}/{} part {}/{}'.format(test_name, trial, trial_count - 1, part, average_count - 1))
+    aggregate = data_aggregator.Aggregate()
+    with ProcessPoolExecutor(max_workers=POOL_SIZE) as executor:
+        futures = {}
+        for i in range(trial_count):
+            # Get the new trial settings.
+            callback(settings, i)
+            trial = str(i).zfill(5)
+
+            for j in range(average_count):
+                part_settings = dict(settings)
+                if settings['RANDOM_SEED'] is not None:
+                    # Give every part its own reproducible stream.
+                    part_settings['RANDOM_SEED'] = [settings['RANDOM_SEED'],
+                                                    i, j]
+                future = executor.submit(analyze_trial_part, part_settings)
+                futures[future] = (trial, j)
+
+        for future in as_completed(futures):
+            trial, part = futures[future]
+            metrics = future.result()
+            if metrics is None:
+                print('Couldn\'t get data for', test_name, trial)
+            aggregate.add(test_name, trial, metrics)
+            means = aggregate.means(test_name, trial)
+            print('< {} trial {} part {}: {}'.format(test_name, trial, part,
+                                                     json.dumps(means)))
             sys.stdout.flush()
-            return proc_data
-        except:
-            procs.append(proc_data)
+
+    output = aggregate.output()
+    with open(PATH + test_name + '.json', 'w') as output_file:
+        output_file.write(json.dumps(output))
+    print(json.dumps(output))
+    print()
+    sys.stdout.flush()
+
+
+def analyze_trial_part(settings):
+    """Run a single simulation in a worker process and return its stat_v1
+    metrics, or None if they couldn't be worked out."""
+    import stat_v1
+    state = plane_v1.run_simulation(settings)
+    coords, heights = plane_v1.collect_stems(state)
+    try:
+        metrics = stat_v1.analyze_stems(settings, coords, heights)
+    except Exception:
+        # Not enough points to get data in all likelihood, since
+        # triangulation has a minimum.
+        return None
+    metrics['STEPS_COMPLETED'] = state['steps_completed']
+    return metrics
+
+
+def run_trial_part(settings, output_file_name):
+    """Run a single simulation in a worker process, write its stems to
+    `output_file_name` and return how many there were along with the number
+    of steps run, which is less than DROP_COUNT if the run converged."""
+    state = plane_v1.run_simulation(settings)
+    coords, heights = plane_v1.collect_stems(state)
+    stem_io.write_stems(output_file_name, settings, coords, heights,
+                        plane_v1.output_extras(state))
+    return len(heights), state['steps_completed']
 
 
 if __name__ == "__main__":
@@ -1,18 +1,36 @@
 class Drop():
+    """A stem as stored in a kdtree: a 2D point along with its ident.
+
+    kdtree indexes, compares and measures its points constantly, so a Drop
+    keeps its coordinates in slots of its own and answers without any loops.
+    Drops are equal to any point with the same coordinates.
+    """
+
+    __slots__ = ('x', 'y', 'ident')
+
     def __init__(self, coord, ident):
-        self.coord = coord
+        self.x, self.y = coord
         self.ident = ident
-        assert len(self.coord) == 2
+
+    @property
+    def coord(self):
+        return (self.x, self.y)
 
     def __len__(self):
-        return len(self.coord)
+        return 2
 
     def __getitem__(self, i):
-        assert i >= 0
-        return self.coord[i]
+        if i == 0:
+            return self.x
+        if i == 1:
+            return self.y
+        raise IndexError('Drop index out of range.')
 
     def __eq__(self, other):
-        for i in range(len(self)):
-            if self[i] != other[i]:
-                return False
-        return True
+        return self.x == other[0] and self.y == other[1]
+
+    def __hash__(self):
+        return hash((self.x, self.y))
+
+    def __repr__(self):
+        return 'Drop(({}, {}), ident={})'.format(self.x, self.y, self.ident)
@@ -15,6 +15,12 @@ STEM_RADIUS = DROP_RADIUS
 BOUNCE_DISTANCE = 5 * DROP_RADIUS
 # The shape of this 2D plane.
 PLANE_SHAPE = util.DISK
+# Radius of the plane when it is a disk.
+PLANE_RADIUS = 1
+# Width and height of the plane when it is a square (a rectangle if they
+# differ).
+PLANE_WIDTH = 2
+PLANE_HEIGHT = 2
 # The probability that any given stem will melt after a single simulation step.
 MELT_PROBABILITY = 0.00003#0.03
 # The probability that a drop will stick to the ground.
@@ -29,6 +35,9 @@ INTERACTIVE_DELAY = 0.2
 INTERACTIVE_FAST_MODE = False
 # Interval for INTERACTIVE_FAST_MODE.
 INTERACTIVE_FAST_INTERVAL = 50000
+# In INTERACTIVE_FAST_MODE, draw in a separate process so the simulation
+# never waits on drawing.
+ASYNC_DRAWING = True
 # Additional height to add to a stem if a drop lands on it after a bounce.
 BOUNCE_HEIGHT_ADDITION = 20
 # Weight to apply to old genome when creting a new one after a drop lands on a stem.
@@ -37,8 +46,49 @@ OLD_GENOME_BIAS = 1000000000#40
 SHOW_BOUNCE_RADIUS = False
 # Number of steps before doing a relatively larger melt (for efficiency).
 MELT_INTERVAL = 30
-# Use a looping boundary (only when PLANE_SHAPE == DISK).
+# How stems melt: 'interval' melts every stem every MELT_INTERVAL steps, 'lazy'
+# samples the step each stem melts away on and only does work then.
+MELT_MODE = 'interval'
+# Use a looping boundary (only when PLANE_SHAPE == SQUARE).
 PERIODIC_BOUNDARY = False
+# Number of processes to split a single simulation across (1 runs it serially).
+PARALLEL_WORKERS = 1
+# Number of steps the parallel workers run between merging their strips, at
+# most parallel_v1.MAX_EPOCH_MELTS / MELT_PROBABILITY, or None for exactly that.
+PARALLEL_EPOCH_STEPS = None
+# File to save a checkpoint of the simulation to, or None for no checkpoints.
+CHECKPOINT_FILE = None
+# Number of steps between checkpoints.
+CHECKPOINT_INTERVAL = 100000
+# Seed for the random number generators, or None for a different run every time.
+RANDOM_SEED = None
+# Spatial index over the stems, either 'grid' or 'kdtree'.
+STEM_INDEX = 'grid'
+# File to write order metrics to as the simulation runs, or None to skip them.
+STATS_FILE = None
+# Number of steps between recording order metrics to STATS_FILE.
+STATS_INTERVAL = 10000
+# Number of bins in the histograms recorded to STATS_FILE.
+STATS_HISTOGRAM_BINS = 20
+# Record where the simulation spends its time in the output (also set by
+# --profile).
+PROFILE = False
+# Directory to save images of the plane to for movies, or None to not save them.
+FRAME_DIRECTORY = None
+# Number of steps between the images saved to FRAME_DIRECTORY.
+FRAME_INTERVAL = 10000
+# Width and height in pixels of the images saved to FRAME_DIRECTORY.
+FRAME_SIZE = 1024
+# Format of the images saved to FRAME_DIRECTORY: 'png' files, or 'raw' RGB
+# frames appended to a single file.
+FRAME_FORMAT = 'png'
+# Stop once the stems have been stationary over this many STATS_INTERVAL
+# measurements (DROP_COUNT is then only a limit), or 0 to always run
+# DROP_COUNT steps.
+CONVERGENCE_WINDOW = 0
+# How far, relative to their average, the stem count and heights may drift
+# over CONVERGENCE_WINDOW for the run to count as converged.
+CONVERGENCE_TOLERANCE = 0.05
 
 
 with open('the_config.json', 'w') as config_file:
@@ -48,6 +98,9 @@ with open('the_config.json', 'w') as config_file:
         "STEM_RADIUS": STEM_RADIUS,
         "BOUNCE_DISTANCE": BOUNCE_DISTANCE,
         "PLANE_SHAPE": PLANE_SHAPE,
+        "PLANE_RADIUS": PLANE_RADIUS,
+        "PLANE_WIDTH": PLANE_WIDTH,
+        "PLANE_HEIGHT": PLANE_HEIGHT,
         "MELT_PROBABILITY": MELT_PROBABILITY,
         "GROUND_STICK_PROBABILITY": GROUND_STICK_PROBABILITY,
         "STEM_STICK_PROBABILITY": STEM_STICK_PROBABILITY,
@@ -55,9 +108,27 @@ with open('the_config.json', 'w') as config_file:
         "INTERACTIVE_DELAY": INTERACTIVE_DELAY,
         "INTERACTIVE_FAST_MODE": INTERACTIVE_FAST_MODE,
         "INTERACTIVE_FAST_INTERVAL": INTERACTIVE_FAST_INTERVAL,
+        "ASYNC_DRAWING": ASYNC_DRAWING,
         "BOUNCE_HEIGHT_ADDITION": BOUNCE_HEIGHT_ADDITION,
         "OLD_GENOME_BIAS": OLD_GENOME_BIAS,
         "SHOW_BOUNCE_RADIUS": SHOW_BOUNCE_RADIUS,
         "MELT_INTERVAL": MELT_INTERVAL,
-        "PERIODIC_BOUNDARY": PERIODIC_BOUNDARY
+        "MELT_MODE": MELT_MODE,
+        "PERIODIC_BOUNDARY": PERIODIC_BOUNDARY,
+        "STEM_INDEX": STEM_INDEX,
+        "RANDOM_SEED": RANDOM_SEED,
+        "PARALLEL_WORKERS": PARALLEL_WORKERS,
+        "PARALLEL_EPOCH_STEPS": PARALLEL_EPOCH_STEPS,
+        "CHECKPOINT_FILE": CHECKPOINT_FILE,
+        "CHECKPOINT_INTERVAL": CHECKPOINT_INTERVAL,
+        "STATS_FILE": STATS_FILE,
+        "STATS_INTERVAL": STATS_INTERVAL,
+        "STATS_HISTOGRAM_BINS": STATS_HISTOGRAM_BINS,
+        "PROFILE": PROFILE,
+        "FRAME_DIRECTORY": FRAME_DIRECTORY,
+        "FRAME_INTERVAL": FRAME_INTERVAL,
+        "FRAME_SIZE": FRAME_SIZE,
+        "FRAME_FORMAT": FRAME_FORMAT,
+        "CONVERGENCE_WINDOW": CONVERGENCE_WINDOW,
+        "CONVERGENCE_TOLERANCE": CONVERGENCE_TOLERANCE
     }}))
@@ -0,0 +1,229 @@
+"""Headless export of simulation frames for making movies.
+
+Every FRAME_INTERVAL steps the stems are rasterized straight into a NumPy
+image, with no matplotlib involved, so this works on machines without a
+display. Images are handed to a background thread that writes them to
+FRAME_DIRECTORY, either as one PNG per frame or, with FRAME_FORMAT 'raw',
+appended to a single stream of raw RGB frames which ffmpeg can read with
+`-f rawvideo -pix_fmt rgb24 -s <width>x<height>`. Images are FRAME_SIZE
+pixels along the longer side of the plane. A frames.json file records the
+size in pixels and the step of every frame, and is kept up to date as
+frames are written so a resumed run can carry on where the last one left
+off.
+"""
+
+
+import json
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+import lazy_melt
+import stem_io
+import util
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+# Formats frames can be written in, selected by the FRAME_FORMAT setting.
+PNG = 'png'
+RAW = 'raw'
+
+# Name of the file raw frames are appended to.
+RAW_FILE_NAME = 'frames.rgb'
+# Name of the file recording the size and steps of the frames.
+INDEX_FILE_NAME = 'frames.json'
+
+# Frames waiting to be written before the simulation has to wait for the writer.
+QUEUE_SIZE = 8
+
+_BACKGROUND = 255
+_BORDER = 0
+
+
+def create_exporter(settings, resume_step=None):
+    """Return a FrameExporter for `settings`, or None if no FRAME_DIRECTORY
+    is set. When `resume_step` is given we add on to the frames already
+    written up to that step."""
+    directory = settings.get('FRAME_DIRECTORY')
+    if not directory:
+        return None
+    return FrameExporter(directory, settings, settings.get('FRAME_SIZE', 1024),
+                         settings.get('FRAME_FORMAT', PNG), resume_step)
+
+
+class FrameExporter():
+    """Rasterizes the state of a simulation and writes it to `directory`.
+    Pass `record` as the hook to plane_v1.simulate_step(). With a
+    `resume_step` the frames of earlier runs up to that step are kept."""
+
+    def __init__(self, directory, settings, size, frame_format=PNG,
+                 resume_step=None):
+        if frame_format not in (PNG, RAW):
+            raise ValueError('Illegal value for `FRAME_FORMAT`.')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.size = size
+        self.frame_format = frame_format
+        self.bounds = util.plane_bounds(settings)
+        width, height = util.plane_size(settings)
+        # Pixels per unit of length on the plane.
+        scale = size / max(width, height)
+        self.background = _background(settings['PLANE_SHAPE'],
+                                      max(1, round(height * scale)),
+                                      max(1, round(width * scale)))
+        self.stencil = _disk_stencil(settings['DROP_RADIUS'] * scale)
+        # Steps of the frames written so far, oldest first.
+        self.steps = []
+        if resume_step is not None:
+            self.steps = [step for step in _read_steps(directory)
+                          if step <= resume_step]
+
+        self.raw_file = None
+        if frame_format == RAW:
+            self.raw_file = open(os.path.join(directory, RAW_FILE_NAME), 'ab')
+            # Drop any frames the index doesn't list, such as those past the
+            # step we resume from, which the resumed run draws again.
+            self.raw_file.truncate(len(self.steps) * self.background.nbytes)
+        self.frames = queue.Queue(maxsize=QUEUE_SIZE)
+        self.writer = threading.Thread(target=self._write_frames, daemon=True)
+        self.writer.start()
+
+    def record(self, state):
+        """Rasterize the stems in `state` and queue the image to be written."""
+        store = state['store']
+        slots = store.live_slots()
+        heights = lazy_melt.observed_heights(store, state['melter'], slots,
+                                             state['steps_completed'])
+        top = stem_io.top_mask(heights)
+        coords = np.column_stack((store.x[slots[top]], store.y[slots[top]]))
+        image = rasterize(coords, heights[top], self.background, self.stencil,
+                          self.bounds)
+        self.frames.put((state['steps_completed'], image))
+
+    def _write_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            step, image = frame
+            if self.raw_file is not None:
+                self.raw_file.write(image.tobytes())
+                self.raw_file.flush()
+            else:
+                file_name = os.path.join(self.directory,
+                                         'frame_{:010d}.png'.format(step))
+                with open(file_name, 'wb') as frame_file:
+                    frame_file.write(encode_png(image))
+            self.steps.append(step)
+            self._write_index()
+
+    def _write_index(self):
+        # Replace the index atomically so a killed run never leaves a broken
+        # one.
+        file_name = os.path.join(self.directory, INDEX_FILE_NAME)
+        rows, columns, _ = self.background.shape
+        with open(file_name + '.tmp', 'w') as index_file:
+            index_file.write(json.dumps({'size': self.size, 'width': columns,
+                                         'height': rows,
+                                         'format': self.frame_format,
+                                         'steps': self.steps}))
+        os.replace(file_name + '.tmp', file_name)
+
+    def close(self):
+        """Finish writing every queued frame."""
+        self.frames.put(None)
+        self.writer.join()
+        if self.raw_file is not None:
+            self.raw_file.close()
+        self._write_index()
+
+
+def _read_steps(directory):
+    """Return the list of the steps of the frames in the index in
+    `directory`, which is empty if there is no index."""
+    try:
+        with open(os.path.join(directory, INDEX_FILE_NAME)) as index_file:
+            return json.load(index_file)['steps']
+    except FileNotFoundError:
+        return []
+
+
+def rasterize(coords, heights, background, stencil, bounds=(-1, 1, -1, 1)):
+    """Return a copy of the RGB image `background` of the box with the
+    (x_min, x_max, y_min, y_max) `bounds`, with a disk, the pixel offsets of
+    which are `stencil`, drawn at each of the (n, 2) array of `coords` and
+    coloured by the (n,) array of `heights`."""
+    image = background.copy()
+    if len(heights) == 0:
+        return image
+    row_count, column_count, _ = image.shape
+    x_min, x_max, y_min, y_max = bounds
+
+    # Image rows run top to bottom.
+    columns = np.floor((coords[:, 0] - x_min) / (x_max - x_min)
+                       * column_count).astype(np.int64)
+    rows = np.floor((y_max - coords[:, 1]) / (y_max - y_min)
+                    * row_count).astype(np.int64)
+    pixel_rows = (rows[:, np.newaxis] + stencil[0]).ravel()
+    pixel_columns = (columns[:, np.newaxis] + stencil[1]).ravel()
+    red = np.repeat((255 * heights / (heights.max() + 1)).astype(np.uint8),
+                    len(stencil[0]))
+
+    inside = ((pixel_rows >= 0) & (pixel_rows < row_count)
+              & (pixel_columns >= 0) & (pixel_columns < column_count))
+    pixel_rows = pixel_rows[inside]
+    pixel_columns = pixel_columns[inside]
+    image[pixel_rows, pixel_columns, 0] = red[inside]
+    image[pixel_rows, pixel_columns, 1:] = 0
+    return image
+
+
+def _disk_stencil(radius):
+    """Return arrays of the row and column offsets of the pixels in a disk of
+    `radius` pixels, which is never less than a single pixel."""
+    reach = int(np.ceil(radius))
+    rows, columns = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+    inside = rows * rows + columns * columns <= max(radius, 0.5) ** 2
+    return rows[inside], columns[inside]
+
+
+def _background(shape, row_count, column_count):
+    """Return an empty RGB image of the plane with its border drawn on."""
+    image = np.full((row_count, column_count, 3), _BACKGROUND, dtype=np.uint8)
+    if shape == util.DISK:
+        # Distance of each pixel's centre from the middle of the image.
+        row_centres = np.arange(row_count) + 0.5 - row_count / 2
+        column_centres = np.arange(column_count) + 0.5 - column_count / 2
+        distance = np.hypot(row_centres[:, np.newaxis],
+                            column_centres[np.newaxis, :])
+        image[np.abs(distance - column_count / 2) < 1] = _BORDER
+    elif shape == util.SQUARE:
+        image[[0, -1], :] = _BORDER
+        image[:, [0, -1]] = _BORDER
+    return image
+
+
+def encode_png(image):
+    """Return the bytes of an 8-bit RGB PNG of the (height, width, 3) uint8
+    array `image`."""
+    height, width, _ = image.shape
+    # Each scanline starts with a filter type byte, which we leave as none.
+    scanlines = np.zeros((height, 1 + 3 * width), dtype=np.uint8)
+    scanlines[:, 1:] = image.reshape(height, 3 * width)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)),
+        chunk(b'IEND', b'')
+    ])
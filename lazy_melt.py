@@ -0,0 +1,198 @@
+"""Event-driven melting of stems.
+
+At the end of every step each stem melts by one with probability
+MELT_PROBABILITY, independently of everything else, and it is removed once
+its height drops below zero. Because the process is memoryless we don't
+have to simulate it step by step: as soon as a stem's height is set we
+sample the step on which it will die (a negative binomial waiting time) and
+keep it in a priority queue. Each step only the stems whose time has come
+are popped, and a stem's height is only worked out when somebody asks.
+"""
+
+
+import heapq
+import math
+
+import numpy as np
+
+
+# A death step for stems that never melt.
+NEVER = np.iinfo(np.int64).max
+
+# numpy can't draw hypergeometric variates from populations this large.
+_HYPERGEOMETRIC_LIMIT = 10 ** 9
+
+
+def observed_heights(store, melter, slots, step):
+    """Return an array of the heights of the live stems in the array `slots`
+    of `store` as of the start of `step`, to look at rather than to run the
+    simulation with. With a LazyMelter `melter` these are the expected
+    heights, since sampling heights the run hasn't asked for yet would
+    disturb it."""
+    if melter is None:
+        return store.height[slots]
+    return melter.expected_heights(slots, step)
+
+
+class LazyMelter():
+    """Tracks when each stem in a StemStore will melt away.
+
+    For each slot the store keeps `height_step`, the step its height was
+    last brought up to date on, and `death_step`, the step at the end of
+    which it melts away.
+    """
+
+    def __init__(self, store, melt_probability, generator):
+        self.store = store
+        self.melt_probability = melt_probability
+        self.generator = generator
+        # Heap of (death step, slot). Entries whose slot has since died or
+        # been reused are stale and skipped when popped.
+        self.queue = []
+
+    def schedule(self, slot, step):
+        """Sample the death of the stem in `slot`, whose height was set on
+        `step`."""
+        store = self.store
+        store.height_step[slot] = step
+        if self.melt_probability <= 0:
+            store.death_step[slot] = NEVER
+            return
+
+        # The stem dies on the melt that takes it below zero. Melts are
+        # Bernoulli trials at the end of each step, starting with this one.
+        melts_to_die = math.floor(store.height[slot]) + 1
+        trials = melts_to_die + self.generator.negative_binomial(
+            melts_to_die, self.melt_probability)
+        death_step = step + trials - 1
+        store.death_step[slot] = death_step
+        heapq.heappush(self.queue, (death_step, slot))
+
+        # Don't let stale entries pile up forever.
+        if len(self.queue) > 2 * len(store) + 1024:
+            self.rebuild_queue()
+
+    def rebuild_queue(self):
+        """Rebuild the queue from the death steps of the live stems."""
+        store = self.store
+        slots = store.live_slots()
+        death_steps = store.death_step[slots]
+        self.queue = [entry for entry
+                      in zip(death_steps.tolist(), slots.tolist())
+                      if entry[0] != NEVER]
+        heapq.heapify(self.queue)
+
+    def enqueue(self, slots):
+        """Add the death steps of the stems just stored in the array `slots`
+        to the queue."""
+        death_steps = self.store.death_step[slots]
+        entries = [entry for entry in zip(death_steps.tolist(), slots.tolist())
+                   if entry[0] != NEVER]
+        if len(entries) > len(self.queue):
+            self.queue.extend(entries)
+            heapq.heapify(self.queue)
+        else:
+            for entry in entries:
+                heapq.heappush(self.queue, entry)
+
+    def update_height(self, slot, step):
+        """Bring the height of the live stem in `slot` up to date as of the
+        start of `step`. See update_heights()."""
+        store = self.store
+        height_step = int(store.height_step[slot])
+        death_step = int(store.death_step[slot])
+        trials_done = step - height_step
+        if trials_done <= 0 or death_step == NEVER:
+            return
+
+        ngood = math.floor(store.height[slot])
+        if ngood > 0:
+            nbad = death_step - height_step - ngood
+            if nbad < _HYPERGEOMETRIC_LIMIT:
+                melts = self.generator.hypergeometric(ngood, nbad, trials_done)
+            else:
+                melts = self.generator.binomial(
+                    trials_done, ngood / (death_step - height_step))
+            store.height[slot] -= melts
+        store.height_step[slot] = step
+
+    def update_heights(self, slots, step):
+        """Bring the heights of the live stems in the array `slots` up to date
+        as of the start of `step`."""
+        slots, melts = self._sample_melts(slots, step, self.generator)
+        self.store.height[slots] -= melts
+        self.store.height_step[slots] = step
+
+    def sample_heights(self, slots, step, generator):
+        """Return an array of the heights of the live stems in the array
+        `slots` as of the start of `step`, drawn from `generator` and
+        without bringing the stems themselves up to date."""
+        slots = np.asarray(slots, dtype=np.int64)
+        heights = self.store.height[slots]
+        melted_slots, melts = self._sample_melts(slots, step, generator)
+        melted = np.isin(slots, melted_slots)
+        heights[melted] -= melts[np.searchsorted(melted_slots, slots[melted])]
+        return heights
+
+    def _sample_melts(self, slots, step, generator):
+        """Return the sorted array of those of the live stems in the array
+        `slots` which melt before `step` since their height was last brought
+        up to date, and an array of how much each of them melts."""
+        store = self.store
+        slots = np.unique(np.asarray(slots, dtype=np.int64))
+        trials_done = step - store.height_step[slots]
+        todo = (trials_done > 0) & (store.death_step[slots] != NEVER)
+        slots = slots[todo]
+        trials_done = trials_done[todo]
+        if len(slots) == 0:
+            return slots, np.zeros(0, dtype=np.int64)
+
+        # Given that the last melt lands on the death step, the melts before
+        # it are spread uniformly over the trials before it. So the melts in
+        # the trials done so far are hypergeometric.
+        melts_to_die = np.floor(store.height[slots]).astype(np.int64) + 1
+        trials = store.death_step[slots] - store.height_step[slots] + 1
+        ngood = melts_to_die - 1
+        nbad = trials - melts_to_die
+        small = nbad < _HYPERGEOMETRIC_LIMIT
+        melts = np.empty(len(slots), dtype=np.int64)
+        if small.any():
+            melts[small] = generator.hypergeometric(ngood[small], nbad[small],
+                                                    trials_done[small])
+        if not small.all():
+            # Sampling without replacement from a huge population is as good
+            # as sampling with it.
+            large = ~small
+            melts[large] = generator.binomial(
+                trials_done[large], ngood[large] / (trials[large] - 1))
+        return slots, melts
+
+    def expected_heights(self, slots, step):
+        """Return an array of the expected heights of the live stems in the
+        array `slots` as of the start of `step`, without sampling them."""
+        store = self.store
+        heights = store.height[slots]
+        trials_done = step - store.height_step[slots]
+        todo = (trials_done > 0) & (store.death_step[slots] != NEVER)
+        # The mean of the hypergeometric draw in update_heights().
+        ngood = np.floor(heights[todo])
+        trials_before_death = np.maximum(
+            store.death_step[slots][todo] - store.height_step[slots][todo], 1)
+        heights[todo] -= trials_done[todo] * ngood / trials_before_death
+        return heights
+
+    def pop_dead(self, step):
+        """Return a list of the slots of stems that melt away by the end of
+        `step`."""
+        store = self.store
+        queue = self.queue
+        dead_slots = []
+        while queue and queue[0][0] <= step:
+            death_step, slot = heapq.heappop(queue)
+            # A stale entry can match a later stem in the same slot that
+            # dies on the same step, and equal entries come off together.
+            if dead_slots and dead_slots[-1] == slot:
+                continue
+            if store.alive[slot] and store.death_step[slot] == death_step:
+                dead_slots.append(slot)
+        return dead_slots
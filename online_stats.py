@@ -0,0 +1,134 @@
+"""Order metrics recorded while a simulation runs.
+
+Every STATS_INTERVAL steps a few cheap measurements of the stems are taken
+and appended to STATS_FILE as one JSON object per line, so order can be
+watched emerging without waiting for the run to finish and running stat_v1.
+
+The same measurements tell us when a run has settled into a steady state:
+with CONVERGENCE_WINDOW set, a run stops once the stem count and the mean
+and spread of the heights have stopped drifting over the last
+CONVERGENCE_WINDOW measurements.
+"""
+
+
+import json
+
+import numpy as np
+
+import lazy_melt
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+# Default number of bins in the histograms we record.
+DEFAULT_HISTOGRAM_BINS = 20
+
+
+# Measurements that must be stationary for a run to have converged.
+CONVERGENCE_METRICS = ('STEM_COUNT', 'MEAN_HEIGHT', 'HEIGHT_STD_DEV')
+
+
+def create_stats(settings, resuming=False):
+    """Return an OnlineStats for `settings`, or None if neither STATS_FILE
+    nor CONVERGENCE_WINDOW is set. When `resuming` we add on to the
+    existing file."""
+    file_name = settings.get('STATS_FILE') or None
+    window = settings.get('CONVERGENCE_WINDOW') or 0
+    if file_name is None and window == 0:
+        return None
+    return OnlineStats(file_name, settings.get('STATS_INTERVAL', 10000),
+                       settings.get('STATS_HISTOGRAM_BINS',
+                                    DEFAULT_HISTOGRAM_BINS),
+                       resuming, window,
+                       settings.get('CONVERGENCE_TOLERANCE', 0.05))
+
+
+class OnlineStats():
+    """Writes a time series of measurements of a running simulation to
+    `file_name`, if not None. Pass `record` as the hook to
+    plane_v1.simulate_step(); with a nonzero `window` it returns True
+    once the run has converged."""
+
+    def __init__(self, file_name, interval, bins=DEFAULT_HISTOGRAM_BINS,
+                 append=False, window=0, tolerance=0.05):
+        self.interval = interval
+        self.bins = bins
+        self.window = window
+        self.tolerance = tolerance
+        self.stats_file = None
+        if file_name is not None:
+            self.stats_file = open(file_name, 'a' if append else 'w')
+        # Every measurement taken, oldest first.
+        self.records = []
+        self.converged = False
+
+    def record(self, state):
+        """Measure `state` and write the measurement out. Return True if the
+        run has converged."""
+        measurement = measure(state, self.bins)
+        self.records.append(measurement)
+        if self.stats_file is not None:
+            self.stats_file.write(json.dumps(measurement) + '\n')
+            self.stats_file.flush()
+        if self.window:
+            self.converged = is_stationary(self.records[-self.window:],
+                                           self.window, self.tolerance)
+        return self.converged
+
+    def close(self):
+        if self.stats_file is not None:
+            self.stats_file.close()
+
+
+def is_stationary(records, window, tolerance):
+    """Return True if there are `window` measurements in `records` and the
+    CONVERGENCE_METRICS in the older and newer halves of them agree on
+    average to within `tolerance`, relative to their overall average."""
+    if window < 2 or len(records) < window:
+        return False
+    for metric in CONVERGENCE_METRICS:
+        values = np.array([record.get(metric, 0)
+                           for record in records[-window:]], dtype=np.float64)
+        older, newer = values[:window // 2], values[window // 2:]
+        if abs(newer.mean() - older.mean()) > tolerance * values.mean():
+            return False
+    return True
+
+
+def measure(state, bins=DEFAULT_HISTOGRAM_BINS):
+    """Return a dict of cheap order metrics for the stems in `state`."""
+    store = state['store']
+    step = state['steps_completed']
+    slots = store.live_slots()
+    heights = lazy_melt.observed_heights(store, state['melter'], slots, step)
+
+    measurement = {'STEP': step, 'STEM_COUNT': len(slots)}
+    if len(slots) == 0:
+        return measurement
+
+    height_counts, height_edges = np.histogram(heights, bins=bins)
+    measurement.update({
+        'MEAN_HEIGHT': float(heights.mean()),
+        'MAX_HEIGHT': float(heights.max()),
+        'HEIGHT_STD_DEV': float(heights.std()),
+        'HEIGHT_HISTOGRAM': height_counts.tolist(),
+        'HEIGHT_BIN_EDGES': height_edges.tolist()
+    })
+    if len(slots) < 2:
+        return measurement
+
+    # In an ordered pattern every stem is about as far from its nearest
+    # neighbour as every other, so the spread of these distances shrinks.
+    import scipy.spatial
+    coords = np.column_stack((store.x[slots], store.y[slots]))
+    distances, _ = scipy.spatial.cKDTree(coords).query(coords, k=2)
+    distances = distances[:, 1]
+    distance_counts, distance_edges = np.histogram(distances, bins=bins)
+    measurement.update({
+        'NEAREST_NEIGHBOUR_MEAN': float(distances.mean()),
+        'NEAREST_NEIGHBOUR_STD_DEV': float(distances.std()),
+        'NEAREST_NEIGHBOUR_HISTOGRAM': distance_counts.tolist(),
+        'NEAREST_NEIGHBOUR_BIN_EDGES': distance_edges.tolist()
+    })
+    return measurement
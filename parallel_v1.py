@@ -0,0 +1,558 @@
+"""Run a single simulation across several processes.
+
+Drops only interact with stems within a few radii of where they land, so
+the plane is cut into vertical strips and each strip is kept by a worker
+process of its own from the start of a run to its end. The run goes in
+epochs of PARALLEL_EPOCH_STEPS steps:
+
+1. All of the epoch's drops are generated up front and handed to the strip
+   they land in.
+2. Each worker plays its drops in step order, melting its stems on the
+   global schedule. A drop that lands or bounces within DROP_RADIUS +
+   STEM_RADIUS of the strip's border could touch a neighbour's stems, so
+   it is put aside where it got to instead.
+3. The parent process keeps copies of the stems near the borders, which
+   the workers bring up to date by sending it only the ones that changed.
+   It carries on the deferred drops one by one, in step order, against
+   them. Drops that bounce away from the borders are handed back to the
+   strip they are in, to be carried on there, and so on until they have
+   all settled. The stems the parent changed go back to their strips.
+
+The strips are only put together into a full plane for the hook and at
+the end of the run.
+
+Drops in different strips away from the borders can't affect each other,
+so reordering them across strips changes nothing. Deferred drops see the
+plane as of the end of the epoch, without the stems that melted away
+since their step and with the rest melted further than they should be;
+stems they create are melted for the steps they missed. That skews the
+run by as much as a stem melts in an epoch, so an epoch may last no more
+than MAX_EPOCH_MELTS / MELT_PROBABILITY steps, which is also how long it is
+unless PARALLEL_EPOCH_STEPS says otherwise.
+"""
+
+
+import multiprocessing
+
+import numpy as np
+
+import plane_v1
+import util
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+# The most a stem may be expected to melt over an epoch.
+MAX_EPOCH_MELTS = 0.25
+
+# How much further than a drop can reach the parent's copies of the stems
+# near the borders go, so that rounding can't hide a stem from it.
+_BORDER_SLACK = 1e-9
+
+# The fields of a stem that can change while it stays where it is.
+_UPDATED_FIELDS = ('height', 'height_step', 'death_step')
+
+
+def simulate_parallel(state, step_count, hook=None, hook_interval=1):
+    """Run `step_count` steps of the simulation on `state` using
+    `settings['PARALLEL_WORKERS']` processes, returning the final state.
+    `hook` is called as by simulate_step(), with a state that only has the
+    stems in its store: its index and melt queue are left empty."""
+    settings = state['settings']
+    if settings['INTERACTIVE_MODE'] or settings['INTERACTIVE_FAST_MODE']:
+        raise ValueError('Interactive modes can\'t be run in parallel.')
+    interiors = strip_interiors(settings, settings['PARALLEL_WORKERS'])
+    if any(x_min >= x_max for x_min, x_max in interiors):
+        raise ValueError('Illegal value for `PARALLEL_WORKERS`.')
+    epoch_steps = epoch_length(settings, step_count)
+
+    steps_completed = state['steps_completed']
+    final_step = steps_completed + step_count
+    strips = _start_strips(state, interiors)
+    try:
+        border = _Border(state, interiors)
+        while steps_completed < final_step:
+            epoch_end = min(final_step, steps_completed + epoch_steps)
+            if hook is not None:
+                hooks_done = steps_completed // hook_interval
+                epoch_end = min(epoch_end, (hooks_done + 1) * hook_interval)
+            border.run_epoch(strips, steps_completed, epoch_end)
+            steps_completed = epoch_end
+            if hook is not None and steps_completed % hook_interval == 0:
+                hook_state = _merged_state(state, border.collect(strips),
+                                           steps_completed, index=False)
+                if hook(hook_state):
+                    break
+        return _merged_state(state, border.collect(strips), steps_completed)
+    finally:
+        # The workers are only ever waiting on us by now, or of no more use
+        # if something went wrong.
+        for connection, process in strips:
+            process.terminate()
+            process.join()
+            connection.close()
+
+
+def epoch_length(settings, step_count):
+    """Return the number of steps in each epoch of a parallel run of
+    `step_count` steps with `settings`."""
+    epoch_steps = settings.get('PARALLEL_EPOCH_STEPS')
+    if settings['MELT_PROBABILITY'] == 0:
+        # Nothing melts, so the epochs can be as long as we like.
+        return epoch_steps or max(1, step_count)
+    max_epoch_steps = max(
+        1, int(MAX_EPOCH_MELTS / settings['MELT_PROBABILITY']))
+    if epoch_steps is None:
+        return max_epoch_steps
+    if not 1 <= epoch_steps <= max_epoch_steps:
+        raise ValueError('Illegal value for `PARALLEL_EPOCH_STEPS`.')
+    return epoch_steps
+
+
+def strip_interiors(settings, strip_count):
+    """Return a list of the (x_min, x_max) range each strip's worker may
+    play drops in on its own."""
+    margin = settings['DROP_RADIUS'] + settings['STEM_RADIUS']
+    x_min, x_max, _, _ = util.plane_bounds(settings)
+    edges = np.linspace(x_min, x_max, strip_count + 1).tolist()
+    interiors = []
+    for i in range(strip_count):
+        x_min = edges[i] + margin
+        x_max = edges[i + 1] - margin
+        # Drops can bounce off the plane, but with a periodic boundary the
+        # outer edges wrap around onto each other.
+        if not settings['PERIODIC_BOUNDARY']:
+            if i == 0:
+                x_min = -np.inf
+            if i == strip_count - 1:
+                x_max = np.inf
+        interiors.append((x_min, x_max))
+    return interiors
+
+
+def _strip_of(settings, x, strip_count):
+    """Return an array of the strip each x coordinate in `x` falls in."""
+    x_min, x_max, _, _ = util.plane_bounds(settings)
+    inner_edges = np.linspace(x_min, x_max, strip_count + 1)[1:-1]
+    return np.searchsorted(inner_edges, x, side='right')
+
+
+def _merged_state(state, strip_stems, steps_completed, index=True):
+    """Return a state like `state` as of `steps_completed` holding the
+    stems in the list `strip_stems` of each strip's stems, as made by
+    StemStore.export(). Unless `index` is set only the store is filled."""
+    merged = plane_v1.create_state(state['settings'], rng=state['rng'])
+    for stems in strip_stems:
+        if index:
+            plane_v1.load_stems(merged, stems)
+        else:
+            merged['store'].add_many(stems)
+    merged['steps_completed'] = steps_completed
+    return merged
+
+
+def _start_strips(state, interiors):
+    """Start a worker for each strip with the stems of `state` in it,
+    returning a list of (connection, process) pairs."""
+    settings = state['settings']
+    rng = state['rng']
+    stems = state['store'].export()
+    stem_strips = _strip_of(settings, stems['x'], len(interiors))
+
+    strips = []
+    for strip, interior in enumerate(interiors):
+        in_strip = stem_strips == strip
+        strip_stems = {name: stems[name][in_strip] for name in stems}
+        seed = int(rng.generator.integers(2 ** 63))
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_run_strip,
+            args=(worker_connection, settings, seed, interior, strip_stems),
+            daemon=True)
+        process.start()
+        worker_connection.close()
+        strips.append((connection, process))
+    return strips
+
+
+def _ask(strips, messages):
+    """Send each of `strips` its message from `messages`, all at once, and
+    return a list of their replies."""
+    for (connection, _), message in zip(strips, messages):
+        connection.send(message)
+    replies = []
+    for connection, _ in strips:
+        reply = connection.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        replies.append(reply)
+    return replies
+
+
+def _run_strip(connection, settings, seed, interior, stems):
+    """Keep one strip's stems in a worker process and do as the parent
+    says with them over `connection`, until it stops us.
+
+    Every message starts with its kind and the changes the parent has made
+    to the strip's stems since its last message:
+
+    ('epoch', changes, drop_coords, drop_steps, epoch_start, epoch_end)
+        Play an epoch's drops. See _Strip.play().
+    ('carry', changes, drops, epoch_end)
+        Carry on drops the parent handed back. See _Strip.carry().
+    ('export', changes)
+        Send all of the strip's stems, as made by StemStore.export().
+
+    The first two are answered with the changes to the stems near the
+    borders since the last answer, along with the drops deferred.
+    """
+    try:
+        strip = _Strip(settings, seed, interior, stems)
+        while True:
+            message = connection.recv()
+            kind = message[0]
+            strip.apply(message[1])
+            if kind == 'export':
+                connection.send(strip.store.export())
+                continue
+            if kind == 'epoch':
+                deferred = strip.play(*message[2:])
+            else:
+                deferred = strip.carry(*message[2:])
+            connection.send((strip.border_changes(), deferred))
+    except Exception as exception:
+        connection.send(exception)
+
+
+def _carry(simulation, drops, region, epoch_end):
+    """Carry on the drops in the (n, 4) array `drops` of (x, y, bounce
+    count, step) on `simulation`, in step order, within the list of
+    (x_min, x_max) ranges `region`. The plane is as of the end of the epoch
+    up to `epoch_end`. Return the drops that left `region`, the same way."""
+    set_steps = {}
+    deferred = []
+    order = np.argsort(drops[:, 3], kind='stable')
+    for x, y, bounce_count, step in drops[order].tolist():
+        step = int(step)
+        if step % 600 == 0:
+            simulation.geo.rebalance()
+        if simulation.melter is not None:
+            # Stems set by earlier drops may already have melted.
+            simulation.steps_completed = step - 1
+            simulation.melt_lazy()
+        simulation.steps_completed = step
+        slot = simulation.land_drop(x, y, region, int(bounce_count))
+        if slot == plane_v1.DEFERRED:
+            deferred.append(simulation.deferred_drop + (step,))
+        elif slot is not None:
+            set_steps[slot] = step
+
+    simulation.steps_completed = epoch_end - 1
+    if simulation.melter is not None:
+        simulation.melt_lazy()
+    else:
+        _melt_missed(simulation, set_steps, epoch_end)
+    return _drop_array(deferred)
+
+
+def _drop_array(drops):
+    """Return the list of (x, y, bounce count, step) `drops` as an array."""
+    return np.array(drops, dtype=np.float64).reshape(-1, 4)
+
+
+def _melt_missed(simulation, set_steps, epoch_end):
+    """Melt the stems set by deferred drops for the melt steps between the
+    step they were set on and `epoch_end`, which the workers already did."""
+    store = simulation.store
+    MELT_INTERVAL = simulation.melt_interval
+
+    slots = np.array([slot for slot in set_steps if store.alive[slot]],
+                     dtype=np.int64)
+    if len(slots) == 0:
+        return
+    steps = np.array([set_steps[slot] for slot in slots.tolist()],
+                     dtype=np.int64)
+    missed_melts = ((epoch_end - 1) // MELT_INTERVAL
+                    - (steps - 1) // MELT_INTERVAL)
+    store.height[slots] -= simulation.rng.generator.binomial(
+        missed_melts * MELT_INTERVAL, simulation.melt_probability)
+    simulation.remove_stems(slots[store.height[slots] < 0])
+
+
+def _update_stems(state, slots, stems):
+    """Overwrite the _UPDATED_FIELDS of the stems in the array `slots` of
+    `state` with those in `stems`, a dict of arrays."""
+    store = state['store']
+    rescheduled = slots[store.death_step[slots] != stems['death_step']]
+    for name in _UPDATED_FIELDS:
+        getattr(store, name)[slots] = stems[name]
+    if state['melter'] is not None:
+        state['melter'].enqueue(rescheduled)
+
+
+def _updated_fields(store, slots):
+    """Return a dict of the _UPDATED_FIELDS arrays of `store` for `slots`."""
+    return {name: getattr(store, name)[slots] for name in _UPDATED_FIELDS}
+
+
+def _unmoved(store, slots, x, y):
+    """Return a mask of which of the array `slots` of `store` still hold live
+    stems where the arrays `x` and `y` say they were."""
+    return (store.alive[slots] & (store.x[slots] == x[slots])
+            & (store.y[slots] == y[slots]))
+
+
+def _grown(array, size, fill=0):
+    """Return `array`, or a copy of it padded with `fill` if it is shorter
+    than `size`."""
+    if len(array) >= size:
+        return array
+    grown = np.full(max(size, 2 * len(array)), fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class _Strip():
+    """The stems of one strip, kept by its worker for the whole run.
+
+    `shared` marks the slots of the stems the parent has copies of, and
+    `shared_x` and `shared_y` say where each of them was when it got it, to
+    tell it apart from a stem put in the same slot since.
+    """
+
+    def __init__(self, settings, seed, interior, stems):
+        state = plane_v1.create_state(dict(settings, RANDOM_SEED=seed))
+        plane_v1.load_stems(state, stems)
+        self.state = state
+        self.store = state['store']
+        self.simulation = plane_v1.Simulation(state)
+        self.region = [interior]
+        # Drops outside of the interior only reach stems outside of this.
+        margin = settings['DROP_RADIUS'] + settings['STEM_RADIUS']
+        reach = margin * (1 + _BORDER_SLACK)
+        self.inner = (interior[0] + reach, interior[1] - reach)
+        self.shared = np.zeros(0, dtype=bool)
+        self.shared_x = np.zeros(0)
+        self.shared_y = np.zeros(0)
+
+    def play(self, drop_coords, drop_steps, epoch_start, epoch_end):
+        """Play the drops at the (n, 2) array `drop_coords` on the steps in
+        the array `drop_steps`, the strip's share of the epoch from
+        `epoch_start` up to `epoch_end`. Return the drops deferred as an
+        array of (x, y, bounce count, step)."""
+        simulation = self.simulation
+        MELT_INTERVAL = simulation.melt_interval
+        lazy = simulation.melter is not None
+
+        # The steps in this epoch on which every stem melts, in interval mode.
+        first_melt = -(-epoch_start // MELT_INTERVAL) * MELT_INTERVAL
+        melt_steps = list(range(first_melt, epoch_end, MELT_INTERVAL))
+        melt_index = 0
+
+        deferred = []
+        drops = zip(drop_coords.tolist(), drop_steps.tolist())
+        for i, ((x, y), step) in enumerate(drops):
+            # Catch up on melting up to the end of the previous step.
+            if lazy:
+                simulation.steps_completed = step - 1
+                simulation.melt_lazy()
+            else:
+                while (melt_index < len(melt_steps)
+                       and melt_steps[melt_index] < step):
+                    simulation.melt()
+                    melt_index += 1
+
+            if i % 600 == 0:
+                simulation.geo.rebalance()
+            simulation.steps_completed = step
+            if simulation.land_drop(x, y, self.region) == plane_v1.DEFERRED:
+                deferred.append(simulation.deferred_drop + (step,))
+
+        # Finish off the epoch's melting.
+        if lazy:
+            simulation.steps_completed = epoch_end - 1
+            simulation.melt_lazy()
+        else:
+            for _ in range(melt_index, len(melt_steps)):
+                simulation.melt()
+        return _drop_array(deferred)
+
+    def carry(self, drops, epoch_end):
+        """Carry on the drops the parent handed back, in the (n, 4) array
+        `drops` of (x, y, bounce count, step), after the end of the epoch
+        up to `epoch_end`. Return those deferred again, the same way."""
+        return _carry(self.simulation, drops, self.region, epoch_end)
+
+    def apply(self, changes):
+        """Make the `changes` the parent made to its copies of our stems, if
+        any. See _Border.note_changes()."""
+        if changes is None:
+            return
+        removed = changes['removed']
+        self.shared[removed] = False
+        self.simulation.remove_stems(removed)
+        _update_stems(self.state, changes['updated'], changes['updated_stems'])
+        plane_v1.load_stems(self.state, changes['added_stems'])
+
+    def border_changes(self):
+        """Return a dict of the changes the parent should make to its copies
+        of our stems near the borders: the slots of those that went, the
+        slots and _UPDATED_FIELDS of those that stayed, and the slots and
+        stems of those that came."""
+        store = self.store
+        self.shared = _grown(self.shared, store.size)
+        self.shared_x = _grown(self.shared_x, store.size)
+        self.shared_y = _grown(self.shared_y, store.size)
+
+        shared = np.flatnonzero(self.shared)
+        stayed = _unmoved(store, shared, self.shared_x, self.shared_y)
+        removed = shared[~stayed]
+        updated = shared[stayed]
+        self.shared[removed] = False
+
+        slots = store.live_slots()
+        x = store.x[slots]
+        near = slots[(x <= self.inner[0]) | (x >= self.inner[1])]
+        added = near[~self.shared[near]]
+        self.shared[added] = True
+        self.shared_x[added] = store.x[added]
+        self.shared_y[added] = store.y[added]
+        return {
+            'removed': removed,
+            'updated': updated,
+            'updated_stems': _updated_fields(store, updated),
+            'added': added,
+            'added_stems': store.export(added)
+        }
+
+
+class _Border():
+    """The parent's copies of the stems near the borders between strips,
+    against which it carries on the drops the workers defer.
+
+    `owners` holds the strip each copy's stem is in (-1 for a stem of our
+    own) and `owner_slots` its slot there, while `copies` maps each strip's
+    slots to ours. `shared_x` and `shared_y` are as in _Strip.
+    """
+
+    def __init__(self, state, interiors):
+        settings = state['settings']
+        self.settings = settings
+        self.strip_count = len(interiors)
+        self.state = plane_v1.create_state(settings, rng=state['rng'])
+        self.store = self.state['store']
+        self.simulation = plane_v1.Simulation(self.state)
+        # Everywhere outside of the interiors.
+        self.region = [(interiors[i][1], interiors[i + 1][0])
+                       for i in range(self.strip_count - 1)]
+        if settings['PERIODIC_BOUNDARY']:
+            self.region.append((-np.inf, interiors[0][0]))
+            self.region.append((interiors[-1][1], np.inf))
+        self.owners = np.zeros(0, dtype=np.int64)
+        self.owner_slots = np.zeros(0, dtype=np.int64)
+        self.shared_x = np.zeros(0)
+        self.shared_y = np.zeros(0)
+        self.copies = [np.zeros(0, dtype=np.int64) for _ in interiors]
+        # The changes to send each strip with its next message.
+        self.changes = [None] * self.strip_count
+
+    def run_epoch(self, strips, epoch_start, epoch_end):
+        """Run the steps from `epoch_start` up to `epoch_end` on `strips`."""
+        strip_count = self.strip_count
+        drop_coords = self.state['rng'].coords(epoch_end - epoch_start)
+        drop_steps = np.arange(epoch_start, epoch_end)
+        drop_strips = _strip_of(self.settings, drop_coords[:, 0], strip_count)
+        messages = [('epoch', self._take_changes(strip),
+                     drop_coords[drop_strips == strip],
+                     drop_steps[drop_strips == strip], epoch_start, epoch_end)
+                    for strip in range(strip_count)]
+        while True:
+            replies = _ask(strips, messages)
+            for strip, (changes, _) in enumerate(replies):
+                self._apply(strip, changes)
+            deferred = np.concatenate([deferred for _, deferred in replies])
+            handed_back = _carry(self.simulation, deferred, self.region,
+                                 epoch_end)
+            self._note_changes()
+            if len(handed_back) == 0:
+                return
+
+            # Drops that bounced away from the borders are carried on by
+            # the strips they are in now.
+            drop_strips = _strip_of(self.settings, handed_back[:, 0],
+                                    strip_count)
+            messages = [('carry', self._take_changes(strip),
+                         handed_back[drop_strips == strip], epoch_end)
+                        for strip in range(strip_count)]
+
+    def collect(self, strips):
+        """Return a list of the stems of each of `strips`, as made by
+        StemStore.export()."""
+        messages = [('export', self._take_changes(strip))
+                    for strip in range(self.strip_count)]
+        return _ask(strips, messages)
+
+    def _take_changes(self, strip):
+        changes = self.changes[strip]
+        self.changes[strip] = None
+        return changes
+
+    def _grow(self):
+        size = self.store.size
+        self.owners = _grown(self.owners, size, -1)
+        self.owner_slots = _grown(self.owner_slots, size)
+        self.shared_x = _grown(self.shared_x, size)
+        self.shared_y = _grown(self.shared_y, size)
+
+    def _apply(self, strip, changes):
+        """Bring our copies of the stems of `strip` up to date with the
+        `changes` it sent. See _Strip.border_changes()."""
+        copies = self.copies[strip]
+        removed = copies[changes['removed']]
+        self.owners[removed] = -1
+        self.simulation.remove_stems(removed)
+        _update_stems(self.state, copies[changes['updated']],
+                      changes['updated_stems'])
+
+        added = changes['added']
+        if len(added) == 0:
+            return
+        slots = plane_v1.load_stems(self.state, changes['added_stems'])
+        self._grow()
+        self.owners[slots] = strip
+        self.owner_slots[slots] = added
+        self.shared_x[slots] = self.store.x[slots]
+        self.shared_y[slots] = self.store.y[slots]
+        copies = self.copies[strip] = _grown(copies, added.max() + 1, -1)
+        copies[added] = slots
+
+    def _note_changes(self):
+        """Note the changes to send each strip after we carried on drops,
+        and give up the stems we made to the strips they are in."""
+        store = self.store
+        self._grow()
+        shared = np.flatnonzero(self.owners >= 0)
+        stayed = _unmoved(store, shared, self.shared_x, self.shared_y)
+        removed = shared[~stayed]
+        removed_owners = self.owners[removed]
+        self.owners[removed] = -1
+        updated = shared[stayed]
+        updated_owners = self.owners[updated]
+
+        slots = store.live_slots()
+        made = slots[self.owners[slots] < 0]
+        made_stems = store.export(made)
+        made_strips = _strip_of(self.settings, made_stems['x'],
+                                self.strip_count)
+        self.simulation.remove_stems(made)
+
+        for strip in range(self.strip_count):
+            strip_updated = updated[updated_owners == strip]
+            self.changes[strip] = {
+                'removed': self.owner_slots[removed[removed_owners == strip]],
+                'updated': self.owner_slots[strip_updated],
+                'updated_stems': _updated_fields(store, strip_updated),
+                'added_stems': {name: stems[made_strips == strip]
+                                for name, stems in made_stems.items()}
+            }
@@ -6,23 +6,42 @@ TODO: more information here.
 import json
 import math
 from os import sys
+import time
 
-import kdtree
-from matplotlib import pyplot as plt
-import matplotlib
-import matplotlib.patches
-from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
 
-from drop import Drop
 from util import *
-
-import cProfile
+import checkpoint
+import frame_export
+import lazy_melt
+import online_stats
+import profiling
+import stem_io
+import stem_index
+from stem_store import StemStore
+from lazy_melt import LazyMelter
 
 
 __author__ = "Jeremey Chizewer, Joseph Rubin"
 
 
+# Ways of melting stems, selected by the MELT_MODE setting.
+MELT_EVERY_INTERVAL = 'interval'
+MELT_LAZY = 'lazy'
+
+# Returned by land_drop() when a drop leaves the region it was confined to.
+DEFERRED = -1
+
+
+def in_ranges(ranges, x):
+    """Return whether `x` is in any of the (x_min, x_max) `ranges`, which
+    include x_min but not x_max."""
+    for x_min, x_max in ranges:
+        if x_min <= x < x_max:
+            return True
+    return False
+
+
 def bounce_probability(bounce_count):
     """Return the probability that a drop will bounce given that it
     has bounced `bounce_count` times already."""
@@ -31,74 +50,226 @@ def bounce_probability(bounce_count):
 
 def _main():
     """Run a 2D simulation of life."""
+    args = sys.argv[1:]
+
+    # Pull out the options.
+    resume_file_name = None
+    if '--resume' in args:
+        i = args.index('--resume')
+        if i + 1 >= len(args):
+            alert_bad_usage_and_abort()
+        resume_file_name = args[i + 1]
+        del args[i:i + 2]
+    profile = '--profile' in args
+    if profile:
+        args.remove('--profile')
+
     # Validate the cmd args.
-    if len(sys.argv) > 3 or len(sys.argv) < 2 or '--help' in sys.argv:
-        print('usage: {} <json_config_file_name> [output_file_name]'.format(sys.argv[0]), file=sys.stderr)
-        exit(1)
-    if len(sys.argv) < 3:
+    if len(args) > 2 or len(args) < 1 or '--help' in args:
+        alert_bad_usage_and_abort()
+    if len(args) < 2:
         output_file_name = '/dev/null'
     else:
-        output_file_name = sys.argv[2]
+        output_file_name = args[1]
 
     # Load the simulation settings from the JSON config file.
-    json_config_file_name = sys.argv[1]
+    json_config_file_name = args[0]
     with open(json_config_file_name, 'r') as json_config_file:
         settings = json.loads(json_config_file.read())['settings']
+    if profile:
+        settings['PROFILE'] = True
     
-    public_entry(settings, output_file_name)
+    public_entry(settings, output_file_name, resume_file_name)
 
 
-def public_entry(settings, output_file_name):
-    # Define the initial state.
-    state = {'points': {}, 'geo': kdtree.create(dimensions=2), 'steps_completed': 0, 'settings': settings}
+def alert_bad_usage_and_abort():
+    print('usage: {} <json_config_file_name> [output_file_name] '
+          '[--resume <checkpoint_file_name>] [--profile]'.format(sys.argv[0]),
+          file=sys.stderr)
+    exit(1)
+
 
-    visualize_init(settings)
+def public_entry(settings, output_file_name, resume_file_name=None):
+    """Run a simulation with `settings` and write its stems to
+    `output_file_name`. If `resume_file_name` is given, carry on from the
+    checkpoint in it until DROP_COUNT steps have been run in total."""
+    state = run_simulation(settings, resume_file_name)
+    coords, heights = collect_stems(state)
 
-    # Run the simulation.
-    state = simulate_step(state, settings['DROP_COUNT'])
+    # print('Number of stems: ', len(heights), file=sys.stderr)
+
+    # Output the relevant parts of the state.
+    stem_io.write_stems(output_file_name, settings, coords, heights,
+                        output_extras(state))
+
+
+def output_extras(state):
+    """Return a dict of what is worth recording about a finished run besides
+    its settings and stems."""
+    # A run that converged stops short of DROP_COUNT, so record how far it
+    # actually got.
+    extras = {'steps_completed': state['steps_completed']}
+    if state['counters'] is not None:
+        extras['profile'] = state['counters'].report()
+    return extras
+
+
+def run_simulation(settings, resume_file_name=None):
+    """Run a simulation with `settings`, returning its final state. See
+    public_entry(). With CONVERGENCE_WINDOW set the run stops early once it
+    has converged, treating DROP_COUNT as a limit."""
+    # Define the initial state.
+    if resume_file_name is not None:
+        state = checkpoint.load_checkpoint(resume_file_name, create_state,
+                                           settings)
+    else:
+        state = create_state(settings)
 
-    geo = state['geo']
-    points = state['points']
+    # Time the interesting parts of the simulation if asked to.
+    if settings.get('PROFILE'):
+        if settings.get('PARALLEL_WORKERS', 1) > 1:
+            raise ValueError('Parallel runs can\'t be profiled.')
+        state = profiling.instrument(state)
 
-    # Collect all of the stems for later analysis.
-    none_count = 0
-    stems = []
-    for node in kdtree.level_order(geo):
-        # Bug fix for empty root.
-        if node.data is None:
-            none_count += 1
-            assert none_count <= 1
+    # Only open a window when there is something to draw in it, so that
+    # batch runs work without a display. INTERACTIVE_FAST_MODE draws into
+    # a figure of the renderer's own.
+    if settings['INTERACTIVE_MODE']:
+        visualize_init(settings)
+
+    # Record order metrics as we go if asked to, or to check for convergence,
+    # and save frames of the plane for movies.
+    stats = online_stats.create_stats(settings, resume_file_name is not None)
+    resume_step = (state['steps_completed'] if resume_file_name is not None
+                   else None)
+    exporter = frame_export.create_exporter(settings, resume_step)
+    hooks = []
+    if stats is not None:
+        hooks.append((stats.record, stats.interval))
+    if exporter is not None:
+        hooks.append((exporter.record, settings.get('FRAME_INTERVAL', 10000)))
+    hook, hook_interval = combine_hooks(hooks)
+
+    # Run the simulation, saving a checkpoint every so often if asked to.
+    checkpoint_file_name = settings.get('CHECKPOINT_FILE')
+    checkpoint_interval = (settings.get('CHECKPOINT_INTERVAL')
+                           or settings['DROP_COUNT'])
+    while state['steps_completed'] < settings['DROP_COUNT']:
+        step_count = min(checkpoint_interval,
+                         settings['DROP_COUNT'] - state['steps_completed'])
+        state = run_steps(state, step_count, hook, hook_interval)
+        if checkpoint_file_name:
+            checkpoint.save_checkpoint(state, checkpoint_file_name)
+        if stats is not None and stats.converged:
             break
-        assert node is not None
-        point_id = node.data.ident
-        point = points[point_id]
-        stems.append({'coord': point['coord'], 'height': point['height']})
 
-    #print('Number of stems: ', len(stems), file=sys.stderr)
-    #print('Number of points: ', len(points), file=sys.stderr)
+    if stats is not None:
+        stats.close()
+    if exporter is not None:
+        exporter.close()
+    visualize_finish()
+    return state
+
 
-    # Output the relevant parts of the state.
-    _state = {'settings': settings, 'stems': stems}
-    with open(output_file_name, 'w') as output_file:
-        output_file.write(json.dumps(_state))
+def combine_hooks(hooks):
+    """Return a single hook and hook interval for simulate_step() that call
+    each of the hooks in the list of (hook, interval) pairs `hooks` on its
+    own interval. The run stops if any of them returns True."""
+    if not hooks:
+        return None, 1
+    if len(hooks) == 1:
+        return hooks[0]
+
+    def hook(state):
+        stop = False
+        for each_hook, each_interval in hooks:
+            if state['steps_completed'] % each_interval == 0:
+                stop = each_hook(state) or stop
+        return stop
+
+    return hook, math.gcd(*[interval for _, interval in hooks])
+
+
+def collect_stems(state):
+    """Return an (n, 2) array of the coordinates and an (n,) array of the
+    heights of the live stems in `state`."""
+    store = state['store']
+    slots = store.live_slots()
+    heights = store.height[slots]
+    if state['melter'] is not None:
+        # Sample the heights the run hasn't asked for yet from a generator of
+        # their own, so that collecting the stems doesn't change the run.
+        heights = state['melter'].sample_heights(
+            slots, state['steps_completed'], state['rng'].observer_generator)
+    return np.column_stack((store.x[slots], store.y[slots])), heights
+
+
+def create_state(settings, rng=None):
+    """Return the initial state of a simulation with `settings`, drawing
+    random numbers from `rng` if given."""
+    store = StemStore()
+    if rng is None:
+        rng = RandomStream(settings['PLANE_SHAPE'], settings.get('RANDOM_SEED'),
+                           size=plane_size(settings))
+    melt_mode = settings.get('MELT_MODE', MELT_EVERY_INTERVAL)
+    if melt_mode == MELT_LAZY:
+        melter = LazyMelter(store, settings['MELT_PROBABILITY'], rng.generator)
+    elif melt_mode == MELT_EVERY_INTERVAL:
+        melter = None
+    else:
+        raise ValueError('Illegal value for `MELT_MODE`.')
+    return {'store': store, 'geo': stem_index.create_index(settings),
+            'melter': melter, 'rng': rng, 'steps_completed': 0,
+            'settings': settings, 'counters': None}
+
+
+def run_steps(state, step_count, hook=None, hook_interval=1):
+    """Run `step_count` steps of the simulation on `state` with the serial
+    or parallel engine as the settings ask, returning the final state. See
+    simulate_step() and parallel_v1.simulate_parallel() for `hook`."""
+    if state['settings'].get('PARALLEL_WORKERS', 1) <= 1:
+        return simulate_step(state, step_count, hook, hook_interval)
+
+    # Only pull in the parallel engine when we need it.
+    import parallel_v1
+    return parallel_v1.simulate_parallel(state, step_count, hook, hook_interval)
+
+
+def load_stems(state, stems):
+    """Add the stems in `stems`, a dict of arrays as made by
+    StemStore.export(), to `state` and return an array of their slots."""
+    slots = state['store'].add_many(stems)
+    state['geo'].add_many(np.column_stack((stems['x'], stems['y'])), slots)
+    if state['melter'] is not None:
+        state['melter'].enqueue(slots)
+    return slots
 
 
 def visualize_init(settings):
+    # Plotting is only imported when we draw, to keep batch runs light.
+    import matplotlib
+    import matplotlib.patches
     matplotlib.use('TkAgg')
+    from matplotlib import pyplot as plt
     plt.clf()
     fig = plt.gcf()
     ax = plt.gca()
     fig.set_size_inches(12, 12)
     ax.axis('equal', adjustable='datalim')
-    ax.set(xlim=(-1.5, 1.5), ylim=(-1.5, 1.5))
+    xlim, ylim = plot_limits(settings)
+    ax.set(xlim=xlim, ylim=ylim)
+    x_min, x_max, y_min, y_max = plane_bounds(settings)
     if settings['PLANE_SHAPE'] == DISK:
-        ax.add_artist(plt.Circle((0,0), radius=1, fill=False))
+        ax.add_artist(plt.Circle((0, 0), radius=x_max, fill=False))
     elif settings['PLANE_SHAPE'] == SQUARE:
-        border = matplotlib.patches.Rectangle((-1, -1), 2, 2, fill=False)
+        border = matplotlib.patches.Rectangle((x_min, y_min), x_max - x_min,
+                                              y_max - y_min, fill=False)
         ax.add_patch(border)
 
 
 def visualize_random(settings, count=100):
+    import matplotlib.patches
+    from matplotlib import pyplot as plt
     fig = plt.gcf()
     fig.clf()
     
@@ -106,16 +277,19 @@ def visualize_random(settings, count=100):
     ax.cla()
     fig.set_size_inches(12, 12)
     ax.axis('equal', adjustable='datalim')
-    ax.set(xlim=(-1.5, 1.5), ylim=(-1.5, 1.5))
+    xlim, ylim = plot_limits(settings)
+    ax.set(xlim=xlim, ylim=ylim)
 
+    x_min, x_max, y_min, y_max = plane_bounds(settings)
     if settings['PLANE_SHAPE'] == DISK:
-        ax.add_artist(plt.Circle((0,0), radius=1, fill=False))
+        ax.add_artist(plt.Circle((0, 0), radius=x_max, fill=False))
     elif settings['PLANE_SHAPE'] == SQUARE:
-        border = matplotlib.patches.Rectangle((-1, -1), 2, 2, fill=False)
+        border = matplotlib.patches.Rectangle((x_min, y_min), x_max - x_min,
+                                              y_max - y_min, fill=False)
         ax.add_patch(border)
 
     for _ in range(count):
-        coord = random_coord(settings['PLANE_SHAPE'])
+        coord = random_coord(settings['PLANE_SHAPE'], plane_size(settings))
         drop_artist = plt.Circle((coord[0], coord[1]), radius=settings['DROP_RADIUS'], fill=True, color=(0, 0, 0, 1))
         ax.add_artist(drop_artist)
         if settings['SHOW_BOUNCE_RADIUS']:
@@ -132,72 +306,36 @@ def visualize_random(settings, count=100):
     plt.show()
 
 
-last_fast_draw_artists = []
+# The renderer INTERACTIVE_FAST_MODE draws with, made on the first draw.
+fast_renderer = None
 def visualize_state(state):
-    global last_fast_draw_artists
-    for artist in last_fast_draw_artists:
-        artist.remove()
-    last_fast_draw_artists = []
-
-    points = state['points']
-    geo = state['geo']
+    global fast_renderer
+    store = state['store']
     settings = state['settings']
+    if fast_renderer is None:
+        import renderer
+        fast_renderer = renderer.create_renderer(settings)
+
+    slots = store.live_slots()
+    heights = lazy_melt.observed_heights(store, state['melter'], slots,
+                                         state['steps_completed'])
+    top = stem_io.top_mask(heights)
+    coords = np.column_stack((store.x[slots[top]], store.y[slots[top]]))
+    fast_renderer.draw(coords, heights[top])
+    #plt.savefig("gallery1/{}.png".format(state['steps_completed']))
 
 
-    fig = plt.gcf()    
-    ax = plt.gca()
-
-    if settings['PLANE_SHAPE'] == DISK:
-        border = plt.Circle((0,0), radius=1, fill=False)
-        ax.add_artist(border)
-        last_fast_draw_artists.append(border)
-    elif settings['PLANE_SHAPE'] == SQUARE:
-        border = matplotlib.patches.Rectangle((-1, -1), 2, 2, fill=False)
-        ax.add_patch(border)
-        last_fast_draw_artists.append(border)
-
-    height_max = None
-    for point_id in points:
-        point = points[point_id]
-        height = point['height']
-        if height_max is None or height > height_max:
-            height_max = height
-
-    none_count = 0
-    for node in kdtree.level_order(geo):
-        # Bug fix for empty root.
-        if node.data is None:
-            none_count += 1
-            assert none_count <= 1
-            break
-        assert node is not None
-        point_id = node.data.ident
-        point = points[point_id]
-        coord = point['coord']
-        height = point['height']
-        if height < 0.5 * height_max:
-            continue
-        color = (height / (height_max + 1))
-        drop_artist = plt.Circle((coord[0], coord[1]), radius=settings['DROP_RADIUS'], fill=True, color=(color, 0, 0, 1))
-        ax.add_artist(drop_artist)
-        last_fast_draw_artists.append(drop_artist)
-        if settings['SHOW_BOUNCE_RADIUS']:
-            bounce_artist_outer = plt.Circle((coord[0], coord[1]),
-                                             radius=settings['BOUNCE_DISTANCE'] + settings['DROP_RADIUS'],
-                                             fill=False, color=(color, 0, 0, 1))
-            bounce_artist_inner = plt.Circle((coord[0], coord[1]),
-                                             radius=settings['BOUNCE_DISTANCE'] - settings['DROP_RADIUS'],
-                                             fill=False, color=(color, 0, 0, 1))
-            ax.add_artist(bounce_artist_outer)
-            ax.add_artist(bounce_artist_inner)
-
-    plt.draw()
-    #plt.savefig("gallery1/{}.png".format(state['steps_completed']))
-    plt.pause(settings['INTERACTIVE_DELAY'])
+def visualize_finish():
+    """Close the renderer, if any, once the simulation is over."""
+    global fast_renderer
+    if fast_renderer is not None:
+        fast_renderer.close()
+        fast_renderer = None
 
 
 def visualize_drop(coords, settings):
     """Draw a single drop on the screen."""
+    from matplotlib import pyplot as plt
     fig = plt.gcf()
     ax = plt.gca()
     drop_artist = plt.Circle((coords[0], coords[1]), radius=settings['DROP_RADIUS'], fill=True, color=(1, 0, 0, 0.4))
@@ -208,6 +346,7 @@ def visualize_drop(coords, settings):
 
 
 def visualize_drop_bounce(coords, settings):
+    from matplotlib import pyplot as plt
     fig = plt.gcf()
     ax = plt.gca()
     drop_artist = plt.Circle((coords[0], coords[1]), radius=settings['DROP_RADIUS'], fill=True, color=(0, 1, 0, 0.4))
@@ -219,6 +358,7 @@ def visualize_drop_bounce(coords, settings):
 
 def visualize_drop_active(coords, settings):
     """Draw a single drop on the screen."""
+    from matplotlib import pyplot as plt
     fig = plt.gcf()
     ax = plt.gca()
     drop_artist = plt.Circle((coords[0], coords[1]), radius=settings['DROP_RADIUS'], fill=True, color=(0, 0, 1, 0.4))
@@ -229,203 +369,307 @@ def visualize_drop_active(coords, settings):
 
 
 def unvisualize_drop(artist):
+    from matplotlib import pyplot as plt
     artist.remove()
     plt.draw()
 
 
-def simulate_step(state, step_count=1):
+def simulate_step(state, step_count=1, hook=None, hook_interval=1):
     """Run `step_count` steps of the simulation on `state`, returning
-    the final state."""
-    for _ in range(step_count):
-        state = _simulate_single_step(state)
-    return state
+    the final state. If given, `hook` is called with the state after each
+    step that brings the number of steps completed to a multiple of
+    `hook_interval`, and we stop early if it returns True."""
+    return Simulation(state).run(step_count, hook, hook_interval)
 
 
-def _simulate_single_step(state):
-    """Run a single step of the simulation on `state`, returning the next state."""
-    # Recover the important parts of our state.
-    geo = state['geo']
-    points = state['points']
-    steps_completed = state['steps_completed']
-    settings = state['settings']
-
-    PLANE_SHAPE = settings['PLANE_SHAPE']
-    DROP_RADIUS = settings['DROP_RADIUS']
-    STEM_RADIUS = settings['STEM_RADIUS']
-    STEM_STICK_PROBABILITY = settings['STEM_STICK_PROBABILITY']
-    GROUND_STICK_PROBABILITY = settings['GROUND_STICK_PROBABILITY']
-    OLD_GENOME_BIAS = settings['OLD_GENOME_BIAS']
-    MELT_INTERVAL = settings['MELT_INTERVAL']
-    INTERACTIVE_MODE = settings['INTERACTIVE_MODE']
-    PERIODIC_BOUNDARY = settings['PERIODIC_BOUNDARY']
-    BOUNCE_DISTANCE = settings['BOUNCE_DISTANCE']
-
-    # We're constantly removing and adding to our kdtree, so rebalance it every
-    # so often for efficiency.
-    if len(points) != 0 and steps_completed % 600 == 0 and geo.data is not None:
-        geo = geo.rebalance()
-
-    # In interactive fast mode we draw the state every so often.
-    if settings['INTERACTIVE_FAST_MODE'] and len(points) != 0:
-        if steps_completed % settings['INTERACTIVE_FAST_INTERVAL'] == 0:
-            visualize_state(state)
-
-    # Create a new drop in the plane.
-    drop_coord = random_coord(PLANE_SHAPE)
-
-    drop_artist = None
-    if settings['INTERACTIVE_MODE']:
-        drop_artist = visualize_drop_active(drop_coord, settings)
-
-    # The drop can keep bouncing as long as it intersects a stem
-    # and hasn't stuck yet. The bounce probability is determined
-    # by bounce_probability(bounce_count).
-    drop_stuck = False
-    bounce_count = 0
-    while not drop_stuck:
-        # Check intersection with any stem.
-        drop_stem_intersect = False
-
-        # Search the tree for any drop intersections.
-        intersections = geo.search_nn_dist(drop_coord, (DROP_RADIUS + STEM_RADIUS) * (DROP_RADIUS + STEM_RADIUS))
-        if settings['PERIODIC_BOUNDARY']:
-            phantom_drops = [
-                (drop_coord[0] + 2, drop_coord[1]),
-                (drop_coord[0] - 2, drop_coord[1]),
-                (drop_coord[0], drop_coord[1] + 2),
-                (drop_coord[0], drop_coord[1] - 2),
-                (drop_coord[0] + 2, drop_coord[1] + 2),
-                (drop_coord[0] + 2, drop_coord[1] - 2),
-                (drop_coord[0] - 2, drop_coord[1] + 2),
-                (drop_coord[0] - 2, drop_coord[1] - 2)
-            ]
-            for phantom_drop in phantom_drops:
-                intersections.extend(geo.search_nn_dist(phantom_drop, (DROP_RADIUS + STEM_RADIUS) * (DROP_RADIUS + STEM_RADIUS)))
-
-        if intersections:
-            # The drop has intersected with some other drops that are already there.
-            # Find the drop that is the highest up.
-            highest_point_height = None
-            highest_point = None
-            highest_point_id = None
-            for node in intersections:
-                point_id = node.ident
-                point = points[point_id]
-
-                assert node == point['coord']
-                
-                intersection_height = point['height']
-                if highest_point_height is None or intersection_height > highest_point_height:
-                    highest_point_height = intersection_height
-                    highest_point = point
-                    highest_point_id = point_id
-            drop_stem_intersect = True
-
-        # Check if the drop bounces.
-        if drop_stem_intersect and random_real() <= bounce_probability(bounce_count):
-            assert highest_point is not None
-            if settings['INTERACTIVE_MODE']:
-                unvisualize_drop(drop_artist)
-            # The drop bounces.
-            bounce_count += 1
-            bounce_angle = random_theta()
-            bounce_offset = polar_to_cartesian(BOUNCE_DISTANCE, bounce_angle)
-
-            # For periodic boundary conditions we roll over from the edges of the boundary.
-            if PERIODIC_BOUNDARY:
-                assert PLANE_SHAPE == SQUARE
-                drop_coord = [highest_point['coord'][0] + bounce_offset[0], highest_point['coord'][1] + bounce_offset[1]]
-                if drop_coord[0] > 1:
-                    drop_coord[0] -= 2
-                if drop_coord[1] > 1:
-                    drop_coord[1] -= 2
-                if drop_coord[0] < -1:
-                    drop_coord[0] += 2
-                if drop_coord[1] < -1:
-                    drop_coord[1] += 2
-                drop_coord = tuple(drop_coord)
-            else:
-                drop_coord = (highest_point['coord'][0] + bounce_offset[0], highest_point['coord'][1] + bounce_offset[1])
-
-            if INTERACTIVE_MODE:
-                drop_artist = visualize_drop_bounce(drop_coord)
-        else:
-            # The drop does not bounce.
-            drop_stuck = True
-            if drop_stem_intersect:
-                # The drop has landed on top of an existing stem. Replace
-                # the top of the stem with the new drop.
-                if random_real() <= STEM_STICK_PROBABILITY:
-                    if INTERACTIVE_MODE:
-                        unvisualize_drop(drop_artist)
-                        drop_artist = visualize_drop(drop_coord)
-                        unvisualize_drop(highest_point['artist'])
-                    geo = geo.remove(highest_point['coord'])
-                    assert drop_coord is not None
-                    new_coord = ((OLD_GENOME_BIAS * highest_point['coord'][0] + drop_coord[0]) / (1 + OLD_GENOME_BIAS),
-                                 (OLD_GENOME_BIAS * highest_point['coord'][1] + drop_coord[1]) / (1 + OLD_GENOME_BIAS))
-                    geo.add(Drop(new_coord, ident=steps_completed))
-                    new_height = highest_point['height'] + 1 + settings['BOUNCE_HEIGHT_ADDITION']
-                    points[steps_completed] = {'height': new_height, 'artist': drop_artist, 'coord': new_coord}
-            else:
-                # The drop has landed outside of any stem. Simply add
-                # it as a new stem.
-                if random_real() <= GROUND_STICK_PROBABILITY:
-                    # Create a new stem for this drop.
-                    if INTERACTIVE_MODE:
-                        unvisualize_drop(drop_artist)
-                        drop_artist = visualize_drop(drop_coord)
-                    assert drop_coord is not None
-                    geo.add(Drop(drop_coord, ident=steps_completed))
-                    points[steps_completed] = {'height': 0, 'artist': drop_artist, 'coord': drop_coord}
-                elif INTERACTIVE_MODE:
-                    unvisualize_drop(drop_artist)
-
-    new_state = {'points': points, 'geo': geo, 'steps_completed': steps_completed, 'settings': settings}
-    if steps_completed % MELT_INTERVAL == 0:
-        new_state = melt(new_state)
-
-    return {'points': new_state['points'], 'geo': new_state['geo'], 'steps_completed': new_state['steps_completed'] + 1, 'settings': settings}
+def land_drop(state, drop_coord, region=None):
+    """Drop a single drop at `drop_coord` as part of step
+    `state['steps_completed']`. See Simulation.land_drop()."""
+    simulation = Simulation(state)
+    return simulation.land_drop(drop_coord[0], drop_coord[1], region)
 
 
 def melt(state):
-    steps_completed = state['steps_completed']
-    geo = state['geo']
-    points = state['points']
-    settings = state['settings']
-    MELT_INTERVAL = settings['MELT_INTERVAL']
-    MELT_PROBABILITY = settings['MELT_PROBABILITY']
-    INTERACTIVE_MODE = settings['INTERACTIVE_MODE']
+    """Melt every live stem in `state`. See Simulation.melt()."""
+    Simulation(state).melt()
+    return state
 
-    # Melt stems from the bottom.
-    none_count = 0
-    if len(points) != 0:
-        for node in kdtree.level_order(geo):
-            # Bug fix for empty root.
-            if node.data is None:
-                none_count += 1
-                assert none_count <= 1
-                break
 
-            point_id = node.data.ident
-            point = points[point_id]
+def melt_lazy(state):
+    """Remove the stems in `state` that melt away on the current step."""
+    Simulation(state).melt_lazy()
+    return state
 
-            # Calculate the proper melt amount probabalistically.
-            binom_melt_amount = np.random.binomial(MELT_INTERVAL, MELT_PROBABILITY)
 
-            # There shouldn't be any stems that should have already been removed.
-            assert points[point_id]['height'] >= 0
+def remove_stems(state, dead_slots):
+    """Remove the stems in the array `dead_slots` from the plane."""
+    Simulation(state).remove_stems(dead_slots)
+
+
+class Simulation():
+    """Runs the simulation on a state.
+
+    The settings and the parts of the state are looked up once, when the
+    simulation is made, so that the inner loop works on attributes alone and
+    doesn't build a new state, or unpack the settings, on every step.
+    `steps_completed` is copied back into the state whenever anybody else
+    can see it: before a hook or a drawing, and when run() returns.
+    """
+
+    __slots__ = ('state', 'settings', 'store', 'geo', 'melter', 'rng',
+                 'counters', 'steps_completed', 'plane_shape',
+                 'interaction_distance', 'bounce_distance',
+                 'bounce_height_addition', 'stem_stick_probability',
+                 'ground_stick_probability', 'old_genome_bias', 'torus',
+                 'melt_interval', 'melt_probability', 'interactive_mode',
+                 'interactive_fast_mode', 'interactive_fast_interval',
+                 'deferred_drop')
+
+    def __init__(self, state):
+        settings = state['settings']
+        self.state = state
+        self.settings = settings
+
+        # Recover the important parts of our state.
+        self.store = state['store']
+        self.geo = state['geo']
+        self.melter = state['melter']
+        self.rng = state['rng']
+        self.counters = state['counters']
+        self.steps_completed = state['steps_completed']
+
+        self.plane_shape = settings['PLANE_SHAPE']
+        self.interaction_distance = (settings['DROP_RADIUS']
+                                     + settings['STEM_RADIUS'])
+        self.bounce_distance = settings['BOUNCE_DISTANCE']
+        self.bounce_height_addition = settings['BOUNCE_HEIGHT_ADDITION']
+        self.stem_stick_probability = settings['STEM_STICK_PROBABILITY']
+        self.ground_stick_probability = settings['GROUND_STICK_PROBABILITY']
+        self.old_genome_bias = settings['OLD_GENOME_BIAS']
+        # With a periodic boundary the index knows the plane is a torus.
+        self.torus = self.geo.torus
+        self.melt_interval = settings['MELT_INTERVAL']
+        self.melt_probability = settings['MELT_PROBABILITY']
+        self.interactive_mode = settings['INTERACTIVE_MODE']
+        self.interactive_fast_mode = settings['INTERACTIVE_FAST_MODE']
+        self.interactive_fast_interval = settings['INTERACTIVE_FAST_INTERVAL']
+        # Where the last drop land_drop() deferred had got to.
+        self.deferred_drop = None
+
+    def run(self, step_count, hook=None, hook_interval=1):
+        """Run `step_count` steps and return the state. See simulate_step()."""
+        step = self.step
+        if hook is None:
+            for _ in range(step_count):
+                step()
+        else:
+            state = self.state
+            for _ in range(step_count):
+                step()
+                if self.steps_completed % hook_interval == 0:
+                    state['steps_completed'] = self.steps_completed
+                    if hook(state):
+                        break
+        self.state['steps_completed'] = self.steps_completed
+        return self.state
+
+    def step(self):
+        """Run a single step of the simulation."""
+        steps_completed = self.steps_completed
+
+        # We're constantly removing and adding to our index, so rebalance it
+        # every so often for efficiency (this is free for indices that don't
+        # need it).
+        if steps_completed % 600 == 0 and len(self.geo) != 0:
+            self.geo.rebalance()
+
+        # In interactive fast mode we draw the state every so often.
+        if self.interactive_fast_mode and len(self.store) != 0:
+            if steps_completed % self.interactive_fast_interval == 0:
+                self.state['steps_completed'] = steps_completed
+                visualize_state(self.state)
+
+        # Create a new drop in the plane.
+        x, y = self.rng.coord()
+        self.land_drop(x, y)
+
+        if self.melter is not None:
+            self.melt_lazy()
+        elif steps_completed % self.melt_interval == 0:
+            self.melt()
+
+        self.steps_completed = steps_completed + 1
+
+    def land_drop(self, x, y, region=None, bounce_count=0):
+        """Drop a single drop at (`x`, `y`), which has already bounced
+        `bounce_count` times, and let it bounce until it settles, as part of
+        step `steps_completed`.
+
+        Return the slot of the stem the drop ended up on top of, or None if it
+        didn't stick. If `region` is a list of (x_min, x_max) ranges and the
+        drop lands or bounces outside of all of them, return DEFERRED before
+        adding or removing any stems, and leave the (x, y, bounce_count) it
+        had got to in `deferred_drop` to be carried on from later.
+        """
+        store = self.store
+        geo = self.geo
+        melter = self.melter
+        rng = self.rng
+        interaction_distance = self.interaction_distance
+
+        drop_artist = None
+        if self.interactive_mode:
+            drop_artist = visualize_drop_active((x, y), self.settings)
+
+        # The drop can keep bouncing as long as it intersects a stem
+        # and hasn't stuck yet. The bounce probability is determined
+        # by bounce_probability(bounce_count).
+        while True:
+            if region is not None and not in_ranges(region, x):
+                assert drop_artist is None
+                self.deferred_drop = (x, y, bounce_count)
+                return DEFERRED
+
+            # Search the index for any stem intersections.
+            intersections = geo.search((x, y), interaction_distance)
+            if not intersections:
+                # The drop has landed outside of any stem.
+                return self._land_on_ground(x, y, drop_artist)
+
+            # The drop has intersected with some stems that are already there.
+            # Find the stem that is the highest up.
+            if melter is not None:
+                # In slot order, so that the heights drawn don't depend on
+                # the order in which the stems were found.
+                steps_completed = self.steps_completed
+                for intersection_slot in sorted(intersections):
+                    melter.update_height(intersection_slot, steps_completed)
+            highest_slot = store.highest(intersections)
+
+            # Check if the drop bounces.
+            if rng.real() > bounce_probability(bounce_count):
+                # The drop has landed on top of an existing stem.
+                return self._land_on_stem(x, y, highest_slot, drop_artist)
 
-            # Melt the stem and remove it if its height has decreased past zero.
-            points[point_id]['height'] -= binom_melt_amount
-            if points[point_id]['height'] < 0:
-                geo = geo.remove(point['coord'])
-                if INTERACTIVE_MODE:
-                    unvisualize_drop(point['artist'])
+            # The drop bounces.
+            if self.interactive_mode:
+                unvisualize_drop(drop_artist)
+            bounce_count += 1
+            if self.counters is not None:
+                self.counters.bounces += 1
+            direction_x, direction_y = rng.direction()
+            x = store.x.item(highest_slot) + self.bounce_distance * direction_x
+            y = store.y.item(highest_slot) + self.bounce_distance * direction_y
 
-    return {'points': points, 'geo': geo, 'steps_completed': steps_completed, 'settings': settings}
+            # For periodic boundary conditions we roll over from the edges of the boundary.
+            if self.torus is not None:
+                assert self.plane_shape == SQUARE
+                x, y = self.torus.wrap(x, y)
+
+            if self.interactive_mode:
+                drop_artist = visualize_drop_bounce((x, y), self.settings)
+
+    def _land_on_stem(self, x, y, highest_slot, drop_artist):
+        """Replace the top of the stem in `highest_slot` with the drop at
+        (`x`, `y`) if it sticks, returning the slot of the new stem."""
+        if self.rng.real() > self.stem_stick_probability:
+            return None
+
+        store = self.store
+        if self.interactive_mode:
+            unvisualize_drop(drop_artist)
+            drop_artist = visualize_drop((x, y), self.settings)
+            unvisualize_drop(store.artists[highest_slot])
+        highest_x = store.x.item(highest_slot)
+        highest_y = store.y.item(highest_slot)
+        new_height = (store.height[highest_slot] + 1
+                      + self.bounce_height_addition)
+        self.geo.remove((highest_x, highest_y), highest_slot)
+        store.remove(highest_slot)
+
+        bias = self.old_genome_bias
+        new_coord = ((bias * highest_x + x) / (1 + bias),
+                     (bias * highest_y + y) / (1 + bias))
+        slot = store.add(new_coord, new_height, drop_artist)
+        self.geo.add(new_coord, slot)
+        if self.melter is not None:
+            self.melter.schedule(slot, self.steps_completed)
+        if self.counters is not None:
+            self.counters.replacements += 1
+        return slot
+
+    def _land_on_ground(self, x, y, drop_artist):
+        """Add the drop at (`x`, `y`) as a new stem if it sticks, returning
+        its slot."""
+        if self.rng.real() > self.ground_stick_probability:
+            if self.interactive_mode:
+                unvisualize_drop(drop_artist)
+            return None
+
+        if self.interactive_mode:
+            unvisualize_drop(drop_artist)
+            drop_artist = visualize_drop((x, y), self.settings)
+        coord = (x, y)
+        slot = self.store.add(coord, 0, drop_artist)
+        self.geo.add(coord, slot)
+        if self.melter is not None:
+            self.melter.schedule(slot, self.steps_completed)
+        if self.counters is not None:
+            self.counters.ground_sticks += 1
+        return slot
+
+    def melt(self):
+        """Melt every live stem by the amount it would have melted over the last
+        MELT_INTERVAL steps, removing the stems that melt away entirely."""
+        if self.counters is not None:
+            start = time.perf_counter()
+
+        # Melt stems from the bottom.
+        store = self.store
+        slots = store.live_slots()
+        if len(slots) != 0:
+            height = store.height
+
+            # There shouldn't be any stems that should have already been
+            # removed.
+            assert (height[slots] >= 0).all()
+
+            # Calculate the proper melt amounts probabalistically, all at once.
+            height[slots] -= self.rng.generator.binomial(
+                self.melt_interval, self.melt_probability, size=len(slots))
+
+            # Remove the stems whose height has decreased past zero.
+            self.remove_stems(slots[height[slots] < 0])
+
+        if self.counters is not None:
+            self.counters.melt_time += time.perf_counter() - start
+
+    def melt_lazy(self):
+        """Remove the stems whose sampled death step is the current step."""
+        if self.counters is not None:
+            start = time.perf_counter()
+        dead_slots = self.melter.pop_dead(self.steps_completed)
+        if dead_slots:
+            # Sorted so that slots are freed in the same order however the queue
+            # was built, which keeps resumed runs identical.
+            self.remove_stems(np.sort(dead_slots))
+        if self.counters is not None:
+            self.counters.melt_time += time.perf_counter() - start
+
+    def remove_stems(self, dead_slots):
+        """Remove the stems in the array `dead_slots` from the plane."""
+        if len(dead_slots) == 0:
+            return
+        store = self.store
+        if self.interactive_mode:
+            for slot in dead_slots:
+                unvisualize_drop(store.artists[slot])
+        dead_coords = zip(store.x[dead_slots].tolist(),
+                          store.y[dead_slots].tolist())
+        self.geo.remove_many(list(dead_coords), dead_slots.tolist())
+        store.remove_many(dead_slots)
 
 
 if __name__ == '__main__':
-    #cProfile.run('_main()')
+    # import cProfile; cProfile.run('_main()')
     _main()
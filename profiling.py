@@ -0,0 +1,134 @@
+"""Counters and timers for seeing where a simulation spends its time.
+
+With PROFILE set (or plane_v1's --profile option) the index and the random
+stream of a state are wrapped in proxies that time every call, and the
+simulation counts what happens to its drops. Nothing is wrapped otherwise,
+so an ordinary run pays nothing for any of this.
+"""
+
+
+import time
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+class Counters():
+    """Time spent in, and counts of, the interesting parts of a simulation."""
+
+    def __init__(self):
+        self.index_search_time = 0.0
+        self.index_update_time = 0.0
+        self.rebalance_time = 0.0
+        self.melt_time = 0.0
+        self.rng_time = 0.0
+        self.index_searches = 0
+        self.bounces = 0
+        self.replacements = 0
+        self.ground_sticks = 0
+        self.start_time = time.perf_counter()
+
+    def report(self):
+        """Return a JSON-safe dict of everything recorded so far. Melting
+        includes removing the melted stems from the index."""
+        return {
+            'times': {
+                'total': time.perf_counter() - self.start_time,
+                'index_search': self.index_search_time,
+                'index_update': self.index_update_time,
+                'rebalance': self.rebalance_time,
+                'melt': self.melt_time,
+                'rng': self.rng_time
+            },
+            'counts': {
+                'index_searches': self.index_searches,
+                'bounces': self.bounces,
+                'replacements': self.replacements,
+                'ground_sticks': self.ground_sticks
+            }
+        }
+
+
+def instrument(state):
+    """Return `state` with its index and random stream timed by a new
+    Counters, which is kept in `state['counters']`."""
+    counters = Counters()
+    return dict(state, geo=ProfiledIndex(state['geo'], counters),
+                rng=ProfiledRandomStream(state['rng'], counters),
+                counters=counters)
+
+
+class ProfiledIndex():
+    """Times the calls made to a stem index."""
+
+    def __init__(self, index, counters):
+        self.index = index
+        self.counters = counters
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def add(self, coord, ident):
+        start = time.perf_counter()
+        self.index.add(coord, ident)
+        self.counters.index_update_time += time.perf_counter() - start
+
+    def add_many(self, coords, idents):
+        start = time.perf_counter()
+        self.index.add_many(coords, idents)
+        self.counters.index_update_time += time.perf_counter() - start
+
+    def remove(self, coord, ident):
+        start = time.perf_counter()
+        self.index.remove(coord, ident)
+        self.counters.index_update_time += time.perf_counter() - start
+
+    def remove_many(self, coords, idents):
+        start = time.perf_counter()
+        self.index.remove_many(coords, idents)
+        self.counters.index_update_time += time.perf_counter() - start
+
+    def search(self, coord, radius):
+        start = time.perf_counter()
+        found = self.index.search(coord, radius)
+        self.counters.index_search_time += time.perf_counter() - start
+        self.counters.index_searches += 1
+        return found
+
+    def rebalance(self):
+        start = time.perf_counter()
+        self.index.rebalance()
+        self.counters.rebalance_time += time.perf_counter() - start
+
+
+class ProfiledRandomStream():
+    """Times the numbers drawn one at a time from a RandomStream. Bulk draws
+    from its `generator` are left to whoever makes them."""
+
+    def __init__(self, rng, counters):
+        self.rng = rng
+        self.counters = counters
+
+    def __getattr__(self, name):
+        return getattr(self.rng, name)
+
+    def coord(self):
+        start = time.perf_counter()
+        coord = self.rng.coord()
+        self.counters.rng_time += time.perf_counter() - start
+        return coord
+
+    def real(self):
+        start = time.perf_counter()
+        real = self.rng.real()
+        self.counters.rng_time += time.perf_counter() - start
+        return real
+
+    def direction(self):
+        start = time.perf_counter()
+        direction = self.rng.direction()
+        self.counters.rng_time += time.perf_counter() - start
+        return direction
@@ -0,0 +1,177 @@
+"""Fast drawing of the stems for INTERACTIVE_FAST_MODE.
+
+Instead of a Circle patch per stem and a full redraw of the figure every
+frame, all of the stems are a single EllipseCollection whose offsets and
+colours are updated in place, and only that collection is redrawn on top
+of a saved copy of the background (blitting). With ASYNC_DRAWING the
+figure lives in a process of its own, so the simulation hands over each
+frame and carries on without waiting for it to be drawn.
+"""
+
+
+import multiprocessing
+import queue
+
+import matplotlib
+import matplotlib.collections
+import matplotlib.patches
+import numpy as np
+
+import util
+
+
+__author__ = "Jeremey Chizewer, Joseph Rubin"
+
+
+# The matplotlib backend we draw with.
+BACKEND = 'TkAgg'
+
+
+def create_renderer(settings):
+    """Return a renderer for `settings`, which has draw(coords, heights)
+    and close() methods."""
+    if settings.get('ASYNC_DRAWING', True):
+        return AsyncRenderer(settings)
+    return CollectionRenderer(settings)
+
+
+class CollectionRenderer():
+    """Draws stems into a figure of its own using blitting."""
+
+    def __init__(self, settings, backend=None):
+        matplotlib.use(backend or BACKEND)
+        from matplotlib import pyplot as plt
+        self.delay = settings['INTERACTIVE_DELAY']
+
+        self.figure = plt.figure(figsize=(12, 12))
+        ax = self.axes = self.figure.gca()
+        ax.set_aspect('equal', adjustable='datalim')
+        xlim, ylim = util.plot_limits(settings)
+        ax.set(xlim=xlim, ylim=ylim)
+        x_min, x_max, y_min, y_max = util.plane_bounds(settings)
+        if settings['PLANE_SHAPE'] == util.DISK:
+            ax.add_artist(matplotlib.patches.Circle((0, 0), radius=x_max,
+                                                    fill=False))
+        elif settings['PLANE_SHAPE'] == util.SQUARE:
+            ax.add_patch(matplotlib.patches.Rectangle(
+                (x_min, y_min), x_max - x_min, y_max - y_min, fill=False))
+
+        # Every stem is drawn by the same few collections. Animated artists
+        # are left out of ordinary draws and only drawn by us.
+        drop_radius = settings['DROP_RADIUS']
+        self.collections = [self._add_circles(2 * drop_radius, True)]
+        if settings['SHOW_BOUNCE_RADIUS']:
+            bounce_distance = settings['BOUNCE_DISTANCE']
+            self.collections.append(self._add_circles(
+                2 * (bounce_distance + drop_radius), False))
+            self.collections.append(self._add_circles(
+                2 * (bounce_distance - drop_radius), False))
+
+        # Whenever the whole figure is drawn (e.g. the window is resized),
+        # save the new background and put the stems back on top of it.
+        self.background = None
+        self.figure.canvas.mpl_connect('draw_event', self._on_draw)
+        plt.show(block=False)
+        self.figure.canvas.draw()
+
+    def _add_circles(self, diameter, fill):
+        # matplotlib 3.6 renamed the transOffset argument to offset_transform
+        # and later dropped the old name, so pass whichever this one takes.
+        if hasattr(matplotlib.collections.Collection, 'set_offset_transform'):
+            transform = {'offset_transform': self.axes.transData}
+        else:
+            transform = {'transOffset': self.axes.transData}
+        collection = matplotlib.collections.EllipseCollection(
+            diameter, diameter, 0, units='xy', offsets=np.zeros((0, 2)),
+            animated=True, **transform)
+        if not fill:
+            collection.set_facecolor('none')
+        self.axes.add_collection(collection)
+        return collection
+
+    def _on_draw(self, event):
+        canvas = self.figure.canvas
+        self.background = canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_collections()
+
+    def _draw_collections(self):
+        for collection in self.collections:
+            self.axes.draw_artist(collection)
+
+    def draw(self, coords, heights):
+        """Draw the stems with an (n, 2) array of `coords` and an (n,) array
+        of `heights`, coloured by height."""
+        colors = np.zeros((len(heights), 4))
+        if len(heights) != 0:
+            colors[:, 0] = heights / (heights.max() + 1)
+        colors[:, 3] = 1
+
+        self.collections[0].set_offsets(coords)
+        self.collections[0].set_facecolor(colors)
+        for collection in self.collections[1:]:
+            collection.set_offsets(coords)
+            collection.set_edgecolor(colors)
+
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        self._draw_collections()
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+        if self.delay:
+            # Unlike plt.pause() this doesn't redraw the whole figure.
+            canvas.start_event_loop(self.delay)
+
+    def flush_events(self):
+        self.figure.canvas.flush_events()
+
+    def close(self):
+        from matplotlib import pyplot as plt
+        plt.close(self.figure)
+
+
+class AsyncRenderer():
+    """Hands frames to a CollectionRenderer in another process. If that
+    process is still busy with the last frame, the new one is dropped
+    rather than making the simulation wait."""
+
+    def __init__(self, settings, backend=None):
+        # Start the drawing process afresh rather than forking whatever GUI
+        # state we have.
+        context = multiprocessing.get_context('spawn')
+        self.frames = context.Queue(maxsize=1)
+        self.process = context.Process(
+            target=_draw_frames,
+            args=(settings, backend or BACKEND, self.frames), daemon=True)
+        self.process.start()
+
+    def draw(self, coords, heights):
+        try:
+            self.frames.put_nowait((np.asarray(coords), np.asarray(heights)))
+        except queue.Full:
+            pass
+
+    def close(self):
+        # Don't wait on a drawing process that has already gone away.
+        while self.process.is_alive():
+            try:
+                self.frames.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.process.join()
+
+
+def _draw_frames(settings, backend, frames):
+    """Draw the frames from the queue `frames` until it gives us None."""
+    renderer = CollectionRenderer(dict(settings, INTERACTIVE_DELAY=0), backend)
+    while True:
+        try:
+            frame = frames.get(timeout=0.05)
+        except queue.Empty:
+            # Keep the window responsive between frames.
+            renderer.flush_events()
+            continue
+        if frame is None:
+            break
+        renderer.draw(*frame)
+    renderer.close()
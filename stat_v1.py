@@ -4,17 +4,14 @@ TODO: more information here.
 """
 
 import json
-import math
 from os import sys
-import random
 
-from matplotlib import pyplot as plt
-import matplotlib
-from mpl_toolkits.mplot3d import Axes3D
 import scipy.spatial
 import numpy as np
 
-import plane_v1
+import baseline_cache
+import stem_io
+import util
 
 
 __author__ = "Jeremey Chizewer, Joseph Rubin"
@@ -24,6 +21,13 @@ DISK = 0
 SQUARE = 1
 
 
+# Number of sets of random points the baseline statistics are averaged over.
+BASELINE_DRAWS = 4
+
+# Where baselines are cached between runs, or None to always recompute them.
+BASELINE_CACHE_FILE = 'baseline_cache.json'
+
+
 def _main():
     if len(sys.argv) < 3:
         alert_bad_usage_and_abort()
@@ -34,29 +38,17 @@ def _main():
 
 
 def public_main(filename, output_filename):
-    with open(filename, 'r') as data_file:
-        data = json.loads(data_file.read())
-        settings = data['settings']
-
-        # Compatability.
-        if 'state' in data:
-            points = data['state']['points']
-            stems = data['state']['stems']
-        else:
-            stems = data['stems']
-    
-    # Filter the stems if we would like to.
-    heights = []
-    for point in stems:
-        height = point['height']
-        heights.append(height)
-    max_height = max(heights)
+    data = stem_io.read_stems(filename, top_only=True)
+    metrics = analyze_stems(data['settings'], data['coords'], data['heights'])
+    with open(output_filename, 'w') as output_file:
+        output_file.write(json.dumps(metrics))
 
-    stem_coords = []
-    for point in stems:
-        height = point['height']
-        if height > max_height * 0.5:
-            stem_coords.append(point['coord'])
+
+def analyze_stems(settings, coords, heights):
+    """Return a dict of order metrics for the stems with an (n, 2) array of
+    `coords` and an (n,) array of `heights`, compared against random points."""
+    # Filter the stems if we would like to.
+    stem_coords = np.asarray(coords[stem_io.top_mask(heights)])
 
     # Remove boundary simplices.
     tri = scipy.spatial.Delaunay(stem_coords)
@@ -64,29 +56,14 @@ def public_main(filename, output_filename):
     #simplices_left = [s for i, s in enumerate(tri.simplices) if i not in boundary_simplices]
     #tri.simplices = simplices_left
 
-    # Generate random points for comparison.
-    random_coords = []
-    for i in range(len(stem_coords)):
-        random_coords.append(plane_v1.random_coord(settings['PLANE_SHAPE']))
-
-    random_tri = scipy.spatial.Delaunay(random_coords)
-    #boundary_simplices = [i for i, _ in enumerate(random_tri.simplices) if -1 in random_tri.neighbors[i]]
-    #simplices_left = [s for i, s in enumerate(random_tri.simplices) if i not in boundary_simplices]
-    #random_tri.simplices = simplices_left
-
     tri_angle_std = calculate_angle_stddev(tri, stem_coords)
-    random_tri_angle_std = calculate_angle_stddev(random_tri, random_coords)
     tri_side_length_std = calculate_side_length_stddev(tri, stem_coords)
-    random_tri_side_length_std = calculate_side_length_stddev(random_tri, random_coords)
 
-    with open(output_filename, 'w') as output_file:
-        output_file.write(json.dumps({
-            'STEM_ANGLE_STD_DEV': tri_angle_std,
-            'RANDOM_ANGLE_STD_DEV': random_tri_angle_std,
-            'STEM_SIDE_STD_DEV': tri_side_length_std,
-            'RANDOM_SIDE_STD_DEV': random_tri_side_length_std,
-            'STEM_COUNT': len(stem_coords)
-        }))
+    # Compare against random points.
+    baseline = random_baseline(settings['PLANE_SHAPE'], len(stem_coords),
+                               util.plane_size(settings))
+    random_tri_angle_std = baseline['ANGLE_STD_DEV']
+    random_tri_side_length_std = baseline['SIDE_STD_DEV']
 
     #print('stem angle stddev is', tri_angle_std)
     #print('{} point random angle stddev is'.format(len(stem_coords)), random_tri_angle_std)
@@ -94,75 +71,112 @@ def public_main(filename, output_filename):
     #print('{} point random side length stddev is'.format(len(stem_coords)), random_tri_side_length_std)
 
     #plt.triplot([p[0] for p in tri.points], [p[1] for p in tri.points], tri.simplices)
-    #plt.triplot([p[0] for p in random_tri.points], [p[1] for p in random_tri.points], random_tri.simplices)
     #plt.show()
 
+    return {
+        'STEM_ANGLE_STD_DEV': float(tri_angle_std),
+        'RANDOM_ANGLE_STD_DEV': float(random_tri_angle_std),
+        'STEM_SIDE_STD_DEV': float(tri_side_length_std),
+        'RANDOM_SIDE_STD_DEV': float(random_tri_side_length_std),
+        'RANDOM_ANGLE_STD_DEV_VARIANCE': baseline['ANGLE_STD_DEV_VARIANCE'],
+        'RANDOM_SIDE_STD_DEV_VARIANCE': baseline['SIDE_STD_DEV_VARIANCE'],
+        'STEM_COUNT': len(stem_coords)
+    }
+
+
+def random_baseline(shape, count, size=util.DEFAULT_PLANE_SIZE):
+    """Return a dict of the mean and variance of the angle and side length
+    stddevs of `count` random points in `shape`, the box around which is
+    the (width, height) `size`, from the cache if we can."""
+    if BASELINE_CACHE_FILE is None:
+        return compute_random_baseline(shape, count, size)
+    cache = baseline_cache.BaselineCache(BASELINE_CACHE_FILE)
+    return cache.get(shape, count, compute_random_baseline, size)
+
+
+def compute_random_baseline(shape, count, size=util.DEFAULT_PLANE_SIZE):
+    """Work out the baseline for random_baseline() from BASELINE_DRAWS sets of
+    random points. The points are seeded by `shape` and `count`, so the
+    baseline is the same whether or not it was cached."""
+    rng = util.RandomStream(shape, seed=[shape, count], size=size)
+    angle_stds = []
+    side_length_stds = []
+    for _ in range(BASELINE_DRAWS):
+        random_coords = rng.coords(count)
+        random_tri = scipy.spatial.Delaunay(random_coords)
+        angle_stds.append(calculate_angle_stddev(random_tri, random_coords))
+        side_length_stds.append(calculate_side_length_stddev(random_tri,
+                                                             random_coords))
+    return {
+        'ANGLE_STD_DEV': float(np.mean(angle_stds)),
+        'ANGLE_STD_DEV_VARIANCE': float(np.var(angle_stds)),
+        'SIDE_STD_DEV': float(np.mean(side_length_stds)),
+        'SIDE_STD_DEV_VARIANCE': float(np.var(side_length_stds))
+    }
+
 
 def calculate_angle_stddev(tri, from_coords):
-    angles = []
-    for simplex in tri.simplices:
-        a = from_coords[simplex[0]]
-        b = from_coords[simplex[1]]
-        c = from_coords[simplex[2]]
-        ang1 = calculate_angle(a, b, c)
-        ang2 = calculate_angle(c, a, b)
-        ang3 = calculate_angle(b, c, a)
-        angles.append(ang1)
-        angles.append(ang2)
-        angles.append(ang3)
+    """Return the standard deviation, in degrees, of the interior angles of
+    every triangle in `tri`."""
+    vertices = np.asarray(from_coords, dtype=np.float64)[tri.simplices]
+    # Each corner with the vertices before and after it.
+    a = vertices
+    b = np.roll(vertices, -1, axis=1)
+    c = np.roll(vertices, -2, axis=1)
+    angles = np.abs(np.degrees(
+        np.arctan2(c[..., 1] - b[..., 1], c[..., 0] - b[..., 0])
+        - np.arctan2(a[..., 1] - b[..., 1], a[..., 0] - b[..., 0])))
+    angles = np.where(angles > 180, 360 - angles, angles)
     return np.std(angles)
 
 
 def calculate_side_length_stddev(tri, from_coords):
-    side_lengths = []
-    for simplex in tri.simplices:
-        a = from_coords[simplex[0]]
-        b = from_coords[simplex[1]]
-        c = from_coords[simplex[2]]
-        side_length1 = euclidean_distance(a, b)
-        side_length2 = euclidean_distance(b, c)
-        side_length3 = euclidean_distance(c, a)
-        side_lengths.append(side_length1)
-        side_lengths.append(side_length2)
-        side_lengths.append(side_length3)
+    """Return the standard deviation of the lengths of the edges in `tri`,
+    counting edges shared by two triangles once."""
+    from_coords = np.asarray(from_coords, dtype=np.float64)
+    simplices = tri.simplices
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]],
+                            simplices[:, [2, 0]]])
+    edges.sort(axis=1)
+    # Pack each edge into one integer so np.unique can drop the duplicates.
+    keys = np.unique(edges[:, 0].astype(np.int64) * len(from_coords)
+                     + edges[:, 1])
+    a = from_coords[keys // len(from_coords)]
+    b = from_coords[keys % len(from_coords)]
+    side_lengths = np.hypot(a[:, 0] - b[:, 0], a[:, 1] - b[:, 1])
     return np.std(side_lengths)
 
 
-def euclidean_distance(a, b):
-    dx = a[0] - b[0]
-    dy = a[1] - b[1]
-    return math.sqrt(dx * dx + dy * dy)
-
-
-def calculate_angle(a, b, c):
-    angle = abs(math.degrees(math.atan2(c[1]-b[1], c[0]-b[0]) - math.atan2(a[1]-b[1], a[0]-b[0])))
-    if angle > 180:
-        angle = 360 - angle
-    return angle
-
-
 def alert_bad_usage_and_abort():
-    print('usage: {}: <filename.json> <output_filename.json>'.format(sys.argv[0]), file=sys.stderr)
+    print('usage: {}: <filename.json|filename.stems> <output_filename.json>'
+          .format(sys.argv[0]), file=sys.stderr)
     exit(1)
 
 
 def visualize_init(settings):
+    # Plotting is only imported when we draw, to keep analysis light.
+    import matplotlib
     matplotlib.use('TkAgg')
+    from matplotlib import pyplot as plt
     plt.clf()
     fig = plt.gcf()
     ax = plt.gca()
     #ax = Axes3D(fig)
     fig.set_size_inches(12, 12)
     ax.axis('equal', adjustable='datalim')
-    ax.set(xlim=(-1.5, 1.5), ylim=(-1.5, 1.5))
+    xlim, ylim = util.plot_limits(settings)
+    ax.set(xlim=xlim, ylim=ylim)
     #plt.axis(xmin=0, xmax=1, ymin=0, ymax=1)
     #plt.axis('equal')
     #fname = sys.argv[1] + shape + str(count) + '-' + str(pstick1) + '-' + str(pmelt) + '-' + str(pstick2) + '-' + str(delta) + '-' + str(width) + '-' + str(numdrops) + '-' +  str(minStemLen) + '-' + str(hexa) + '.png'
     #ax.axis('equal')
-    if settings['PLANE_SHAPE'] == DISK: ax.add_artist(plt.Circle((0,0), radius=1, fill=False))
+    if settings['PLANE_SHAPE'] == DISK:
+        radius = util.plane_size(settings)[0] / 2
+        ax.add_artist(plt.Circle((0, 0), radius=radius, fill=False))
 
 
 def visualize_state_points(state, settings):
+    from matplotlib import pyplot as plt
     stems = state['stems']
     points = state['points']
 
@@ -181,6 +195,7 @@ def visualize_state_points(state, settings):
 
 #temp
 def plot(coords):
+    from matplotlib import pyplot as plt
     visualize_init({'PLANE_SHAPE': 0})
     fig = plt.gcf()
     ax = plt.gca()
@@ -191,6 +206,7 @@ def plot(coords):
 
 
 def visualize_state_stems(state, settings):
+    from matplotlib import pyplot as plt
     stems = state['stems']
     points = state['points']
 
@@ -0,0 +1,413 @@
+"""Spatial indices over the stems on the plane.
+
+The simulation only ever asks an index a few things: add a stem, remove a
+stem, and find every stem within some distance of a coordinate. Stems are
+identified by an `ident` chosen by the caller.
+
+With PERIODIC_BOUNDARY the plane is a torus, and a search near an edge also
+finds the stems within reach across it.
+"""
+
+
+import math
+
+import kdtree
+import numpy as np
+
+from drop import Drop
+import util
+
+
+# Kinds of index, selected by the STEM_INDEX setting.
+KDTREE = 'kdtree'
+GRID = 'grid'
+
+# How much further than the search radius a coordinate may be from an edge
+# for us to search across it, so that rounding can't make us miss a stem.
+_WRAP_SLACK = 1e-9
+
+# Grid cells are keyed by column * _KEY_SPAN + row, which is lighter and
+# quicker to hash than a (column, row) tuple when there are millions of them.
+_KEY_SPAN = 1 << 32
+
+# A kdtree is only rebalanced once stems amounting to at least this share of
+# it have been added or removed since it was last built, so that large trees
+# aren't rebuilt over and over for a few changes.
+_REBALANCE_SHARE = 1 / 4
+
+
+def create_index(settings):
+    """Return an empty index of the kind named by `settings['STEM_INDEX']`,
+    on a torus if `settings['PERIODIC_BOUNDARY']` is set."""
+    torus = None
+    if settings.get('PERIODIC_BOUNDARY', False):
+        torus = Torus(*util.plane_bounds(settings))
+    kind = settings.get('STEM_INDEX', GRID)
+    if kind == GRID:
+        return GridIndex(settings['DROP_RADIUS'] + settings['STEM_RADIUS'],
+                         torus)
+    elif kind == KDTREE:
+        return KdTreeIndex(torus)
+    else:
+        raise ValueError('Illegal value for `STEM_INDEX`.')
+
+
+def build_index(settings, coords, idents):
+    """Return an index of the kind named by `settings['STEM_INDEX']` holding
+    the stems with the (n, 2) array of `coords` and the array of `idents`."""
+    index = create_index(settings)
+    index.add_many(np.asarray(coords, dtype=np.float64).reshape(-1, 2),
+                   np.asarray(idents))
+    return index
+
+
+class Torus():
+    """The rectangle from (`x_min`, `y_min`) to (`x_max`, `y_max`) with its
+    opposite edges joined together."""
+
+    def __init__(self, x_min, x_max, y_min, y_max):
+        self.x_min = x_min
+        self.x_max = x_max
+        self.y_min = y_min
+        self.y_max = y_max
+        self.width = x_max - x_min
+        self.height = y_max - y_min
+
+    def wrap(self, x, y):
+        """Return (`x`, `y`) moved back onto the rectangle, if it is less
+        than a width or height off of it."""
+        if x > self.x_max:
+            x -= self.width
+        if y > self.y_max:
+            y -= self.height
+        if x < self.x_min:
+            x += self.width
+        if y < self.y_min:
+            y += self.height
+        return x, y
+
+    def images(self, x, y, radius):
+        """Return a list of where (`x`, `y`) is in the copies of the rectangle
+        around it with stems within `radius` of it, which is only ever
+        the case near an edge."""
+        reach = radius * (1 + _WRAP_SLACK)
+        shifts_x = self._shifts(x, reach, self.x_min, self.x_max, self.width)
+        shifts_y = self._shifts(y, reach, self.y_min, self.y_max, self.height)
+        if not shifts_x and not shifts_y:
+            return []
+        # Across the sides first, then across the corners.
+        images = [(x + shift_x, y) for shift_x in shifts_x]
+        images.extend((x, y + shift_y) for shift_y in shifts_y)
+        images.extend((x + shift_x, y + shift_y)
+                      for shift_x in shifts_x for shift_y in shifts_y)
+        return images
+
+    @staticmethod
+    def _shifts(value, reach, low, high, span):
+        shifts = []
+        if value - reach < low:
+            shifts.append(span)
+        if value + reach > high:
+            shifts.append(-span)
+        return shifts
+
+
+class KdTreeIndex():
+    """Index backed by a kdtree, which must be rebalanced every so often
+    since we are constantly adding and removing stems. Searches wrap
+    around `torus`, if given."""
+
+    def __init__(self, torus=None):
+        self.tree = kdtree.create(dimensions=2)
+        self.count = 0
+        # Stems added or removed since the tree was last built.
+        self.changes = 0
+        self.torus = torus
+
+    def __len__(self):
+        return self.count
+
+    def add(self, coord, ident):
+        self.tree.add(Drop(coord, ident=ident))
+        self.count += 1
+        self.changes += 1
+
+    def remove(self, coord, ident):
+        # kdtree removes whichever node it meets with an equal point, so find
+        # the one holding `ident` and have it remove exactly that node.
+        node = self._find_node(coord, ident)
+        if node is None:
+            raise KeyError(ident)
+        self.tree = self.tree.remove(coord, node)
+        self.count -= 1
+        self.changes += 1
+
+    def _find_node(self, coord, ident):
+        """Return the node holding the stem `ident` at `coord`, or None."""
+        x, y = coord
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            drop = node.data
+            if drop is None:
+                continue
+            if drop.x == x and drop.y == y and drop.ident == ident:
+                return node
+            # Points equal to the splitting value may be on either side.
+            value = y if node.axis else x
+            split = drop.y if node.axis else drop.x
+            if value <= split and node.left is not None:
+                stack.append(node.left)
+            if value >= split and node.right is not None:
+                stack.append(node.right)
+        return None
+
+    def remove_many(self, coords, idents):
+        """Remove many stems at once. When a large share of the tree is going
+        we rebuild it from the survivors instead of removing one at a time."""
+        if len(idents) * 8 < self.count:
+            for coord, ident in zip(coords, idents):
+                self.remove(coord, ident)
+            return
+
+        removed = set(idents)
+        survivors = [drop for drop in _inorder_drops(self.tree)
+                     if drop.ident not in removed]
+        self._build(survivors)
+
+    def add_many(self, coords, idents):
+        """Add the stems with the (n, 2) array of `coords` and the array of
+        `idents` at once, building a balanced tree of them and any stems
+        already in the index."""
+        drops = [Drop(coord, ident)
+                 for coord, ident in zip(coords.tolist(), idents.tolist())]
+        if not drops:
+            return
+        drops = _inorder_drops(self.tree) + drops
+        self._build(drops)
+
+    def search(self, coord, radius):
+        """Return the idents of all stems strictly within `radius` of `coord`.
+
+        We walk the tree ourselves since kdtree's search_nn_dist compares the
+        squared distance against plain offsets from the splitting planes and
+        so skips subtrees that can still hold matches.
+        """
+        found = []
+        if self.tree.data is None:
+            return found
+        x, y = coord
+        self._search(x, y, radius, found)
+        if self.torus is not None:
+            for image_x, image_y in self.torus.images(x, y, radius):
+                self._search(image_x, image_y, radius, found)
+        return found
+
+    def _search(self, x, y, radius, found):
+        radius_squared = radius * radius
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            # Removed leaves are left behind with no data.
+            if node.data is None:
+                continue
+            drop = node.data
+            delta_x = drop.x - x
+            delta_y = drop.y - y
+            if delta_x * delta_x + delta_y * delta_y < radius_squared:
+                found.append(drop.ident)
+            offset = -delta_y if node.axis else -delta_x
+            if offset <= radius and node.left is not None:
+                stack.append(node.left)
+            if offset >= -radius and node.right is not None:
+                stack.append(node.right)
+
+    def rebalance(self):
+        if (self.tree.data is not None
+                and self.changes >= _REBALANCE_SHARE * self.count):
+            self._build(_inorder_drops(self.tree))
+
+    def _build(self, drops):
+        self.tree = _create_tree(drops)
+        self.count = len(drops)
+        self.changes = 0
+
+    def idents(self):
+        """Return a list of the idents of all stems in the index."""
+        idents = []
+        for node in kdtree.level_order(self.tree):
+            # Bug fix for empty root.
+            if node.data is None:
+                break
+            idents.append(node.data.ident)
+        return idents
+
+
+def _inorder_drops(tree):
+    """Return a list of the Drops in the kdtree `tree` in order, as
+    kdtree's inorder() would visit them but without its nested generators."""
+    drops = []
+    stack = []
+    # Nodes are false when they have no data, i.e. are removed leaves.
+    node = tree
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        drops.append(node.data)
+        node = node.right
+    return drops
+
+
+def _next_axis(axis):
+    return 1 - axis
+
+
+def _create_tree(drops):
+    """Return a balanced kdtree of the list of Drops `drops`, split at the
+    medians as kdtree.create() would split it (up to how ties are broken).
+    It is laid out by NumPy a level at a time rather than by sorting Drops in
+    Python at every node."""
+    if not drops:
+        return kdtree.create(dimensions=2)
+    drop_count = len(drops)
+    coords = np.array([(drop.x, drop.y) for drop in drops])
+    # Where each drop comes along each axis, so that sorting a level is
+    # sorting integers.
+    ranks = np.empty((drop_count, 2), dtype=np.int64)
+    for axis in (0, 1):
+        ranks[np.argsort(coords[:, axis], kind='stable'), axis] = (
+            np.arange(drop_count))
+
+    # The drops still to be placed, grouped by the subtree they are in. The
+    # subtrees of each level are numbered left to right, counting the
+    # empty ones, so subtree s has children 2s and 2s + 1.
+    order = np.arange(drop_count)
+    subtree = np.zeros(drop_count, dtype=np.int64)
+    levels = []
+    axis = 0
+    while len(order) != 0:
+        # Sort each subtree along the axis and split it at its median.
+        by_axis = np.argsort(subtree * drop_count + ranks[order, axis])
+        order = order[by_axis]
+        subtree = subtree[by_axis]
+        counts = np.bincount(subtree, minlength=2 ** len(levels))
+        starts = np.cumsum(counts) - counts
+        medians = counts // 2
+        levels.append((order[(starts + medians)[counts != 0]].tolist(),
+                       (counts != 0).tolist(), axis))
+
+        position = np.arange(len(order)) - starts[subtree] - medians[subtree]
+        order = order[position != 0]
+        subtree = 2 * subtree[position != 0] + (position[position != 0] > 0)
+        axis = _next_axis(axis)
+
+    # Make the nodes from the bottom up.
+    nodes = [None] * 2 ** len(levels)
+    for level_drops, occupied, axis in reversed(levels):
+        level_drops = iter(level_drops)
+        nodes = [kdtree.KDNode(drops[next(level_drops)], left, right, axis,
+                               _next_axis, 2) if is_occupied else None
+                 for is_occupied, left, right
+                 in zip(occupied, nodes[0::2], nodes[1::2])]
+    return nodes[0]
+
+
+class GridIndex():
+    """Index backed by a uniform grid hash.
+
+    Every stem has the same radius, so with a cell size equal to the
+    interaction distance a search only has to look at the 3x3 block of cells
+    around a coordinate. Adding and removing are O(1) and there is never any
+    need to rebalance. Searches wrap around `torus`, if given, by looking
+    at the cells across an edge as well when a coordinate is near it.
+    """
+
+    def __init__(self, cell_size, torus=None):
+        self.cell_size = cell_size
+        self.torus = torus
+        # Map cell keys to a dict of ident -> coord for the stems in that cell.
+        self.cells = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _cell_key(self, coord):
+        return (math.floor(coord[0] / self.cell_size) * _KEY_SPAN
+                + math.floor(coord[1] / self.cell_size))
+
+    def add(self, coord, ident):
+        key = self._cell_key(coord)
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = {}
+        cell[ident] = coord
+        self.count += 1
+
+    def remove(self, coord, ident):
+        key = self._cell_key(coord)
+        cell = self.cells[key]
+        del cell[ident]
+        if not cell:
+            del self.cells[key]
+        self.count -= 1
+
+    def remove_many(self, coords, idents):
+        """Remove many stems at once."""
+        for coord, ident in zip(coords, idents):
+            self.remove(coord, ident)
+
+    def add_many(self, coords, idents):
+        """Add the stems with the (n, 2) array of `coords` and the array of
+        `idents` at once."""
+        columns_and_rows = np.floor(coords / self.cell_size).astype(np.int64)
+        keys = (columns_and_rows[:, 0] * _KEY_SPAN
+                + columns_and_rows[:, 1]).tolist()
+        cells = self.cells
+        for key, coord, ident in zip(keys, coords.tolist(), idents.tolist()):
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = {}
+            cell[ident] = tuple(coord)
+        self.count += len(keys)
+
+    def search(self, coord, radius):
+        """Return the idents of stems strictly within `radius` of `coord`."""
+        x, y = coord
+        found = []
+        self._search(x, y, radius, found)
+        if self.torus is not None:
+            for image_x, image_y in self.torus.images(x, y, radius):
+                self._search(image_x, image_y, radius, found)
+        return found
+
+    def _search(self, x, y, radius, found):
+        radius_squared = radius * radius
+        reach = int(math.ceil(radius / self.cell_size))
+        column = math.floor(x / self.cell_size)
+        row = math.floor(y / self.cell_size)
+        cells = self.cells
+
+        for i in range(column - reach, column + reach + 1):
+            column_key = i * _KEY_SPAN
+            for j in range(row - reach, row + reach + 1):
+                cell = cells.get(column_key + j)
+                if cell is None:
+                    continue
+                for ident, stem_coord in cell.items():
+                    delta_x = stem_coord[0] - x
+                    delta_y = stem_coord[1] - y
+                    if delta_x * delta_x + delta_y * delta_y < radius_squared:
+                        found.append(ident)
+
+    def rebalance(self):
+        pass
+
+    def idents(self):
+        """Return a list of the idents of all stems in the index."""
+        idents = []
+        for cell in self.cells.values():
+            idents.extend(cell)
+        return idents
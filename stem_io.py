@@ -0,0 +1,132 @@
+"""Reading and writing the stems a simulation leaves behind.
+
+Two formats are supported, picked by file extension:
+
+- `.stems`: a small binary format. An 8 byte magic string, the length of a
+  JSON header as a little-endian uint64, the header itself (settings, stem
+  count and anything else the writer wants to record), padding up to a
+  64 byte boundary, then the stem coordinates as a contiguous (n, 2) float64
+  array followed by the heights as an (n,) float64 array. The arrays are
+  memory-mapped on read, so nothing is parsed or copied up front.
+- anything else: the original JSON format, an object with `settings` and a
+  `stems` list of `{'coord': [x, y], 'height': h}` objects.
+
+Either way stems are written tallest first and the header records
+`top_count`, the number of stems taller than TOP_FRACTION of the tallest.
+Those are the only stems analysis looks at, so they can be read on their
+own without touching the rest.
+"""
+
+
+import json
+import struct
+
+import numpy as np
+
+
+STEMS_EXTENSION = '.stems'
+
+_MAGIC = b'STEMSv1\x00'
+_ALIGNMENT = 64
+
+# Stems taller than this fraction of the tallest stem are the ones we analyse,
+# draw and export. top_mask() is the one place they are picked out.
+TOP_FRACTION = 0.5
+
+
+def write_stems(file_name, settings, coords, heights, extra=None):
+    """Write stems with an (n, 2) array of `coords` and an (n,) array of
+    `heights` to `file_name`. Keys of the dict `extra` are recorded
+    alongside the settings."""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    heights = np.asarray(heights, dtype=np.float64)
+    assert len(coords) == len(heights)
+
+    # Tallest first, so the top stems are a prefix of the file.
+    order = np.argsort(-heights, kind='stable')
+    coords = np.ascontiguousarray(coords[order])
+    heights = np.ascontiguousarray(heights[order])
+
+    header = dict(extra or {})
+    header['settings'] = settings
+    header['top_count'] = int(np.count_nonzero(top_mask(heights)))
+
+    if not file_name.endswith(STEMS_EXTENSION):
+        header['stems'] = [{'coord': coord, 'height': height}
+                           for coord, height
+                           in zip(coords.tolist(), heights.tolist())]
+        with open(file_name, 'w') as output_file:
+            output_file.write(json.dumps(header))
+        return
+
+    header['count'] = len(heights)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_offset = len(_MAGIC) + 8 + len(header_bytes)
+    padding = -data_offset % _ALIGNMENT
+    with open(file_name, 'wb') as output_file:
+        output_file.write(_MAGIC)
+        output_file.write(struct.pack('<Q', len(header_bytes) + padding))
+        output_file.write(header_bytes)
+        output_file.write(b' ' * padding)
+        output_file.write(coords.astype('<f8').tobytes())
+        output_file.write(heights.astype('<f8').tobytes())
+
+
+def top_mask(heights):
+    """Return a boolean array picking out the stems taller than TOP_FRACTION
+    of the tallest of `heights`."""
+    if len(heights) == 0:
+        return np.zeros(0, dtype=bool)
+    return heights > heights.max() * TOP_FRACTION
+
+
+def read_stems(file_name, top_only=False):
+    """Return a dict with the `settings`, an (n, 2) array of `coords` and
+    an (n,) array of `heights` of the stems in `file_name`, along with any
+    extra keys that were written with them. If `top_only`, only the stems
+    picked out by top_mask() are returned."""
+    data = _read_all_stems(file_name)
+    if top_only:
+        if 'top_count' in data:
+            top = slice(0, data['top_count'])
+        else:
+            # Written before stems were sorted by height.
+            top = top_mask(data['heights'])
+        data['coords'] = data['coords'][top]
+        data['heights'] = data['heights'][top]
+    return data
+
+
+def _read_all_stems(file_name):
+    if not file_name.endswith(STEMS_EXTENSION):
+        with open(file_name, 'r') as data_file:
+            data = json.loads(data_file.read())
+        # Compatability.
+        if 'state' in data:
+            stems = data.pop('state')['stems']
+        else:
+            stems = data.pop('stems')
+        data['coords'] = np.array([stem['coord'] for stem in stems],
+                                  dtype=np.float64).reshape(-1, 2)
+        data['heights'] = np.array([stem['height'] for stem in stems],
+                                   dtype=np.float64)
+        return data
+
+    with open(file_name, 'rb') as data_file:
+        if data_file.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('Not a stems file: {}'.format(file_name))
+        header_length, = struct.unpack('<Q', data_file.read(8))
+        data = json.loads(data_file.read(header_length).decode('utf-8'))
+
+    count = data['count']
+    data_offset = len(_MAGIC) + 8 + header_length
+    if count == 0:
+        data['coords'] = np.zeros((0, 2))
+        data['heights'] = np.zeros(0)
+        return data
+    data['coords'] = np.memmap(file_name, dtype='<f8', mode='r',
+                               offset=data_offset, shape=(count, 2))
+    data['heights'] = np.memmap(file_name, dtype='<f8', mode='r',
+                                offset=data_offset + 16 * count,
+                                shape=(count,))
+    return data
@@ -0,0 +1,155 @@
+"""Compact storage for the stems on the plane.
+
+Stems live in parallel NumPy arrays (structure of arrays) indexed by a slot
+number. When a stem melts away its slot goes on a free list and is handed
+out again to the next new stem, so memory stays proportional to the number
+of live stems rather than to the number of drops that ever stuck.
+"""
+
+
+import numpy as np
+
+
+# The per-stem arrays that describe a stem, besides its alive flag.
+STEM_FIELDS = ('x', 'y', 'height', 'height_step', 'death_step')
+
+
+class StemStore():
+    """Parallel arrays of stem x, y, height and alive flag."""
+
+    def __init__(self, capacity=1024):
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.height = np.zeros(capacity)
+        self.alive = np.zeros(capacity, dtype=bool)
+        # Steps on which each height was last updated and on which each stem
+        # will melt away, only used for lazy melting.
+        self.height_step = np.zeros(capacity, dtype=np.int64)
+        self.death_step = np.zeros(capacity, dtype=np.int64)
+        # Drawing handles, only ever set in INTERACTIVE_MODE.
+        self.artists = [None] * capacity
+        # Slots below `size` that are free to be reused.
+        self.free = []
+        # One past the highest slot ever handed out.
+        self.size = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self):
+        capacity = 2 * len(self.x)
+        for name in STEM_FIELDS + ('alive',):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.artists.extend([None] * (capacity - len(self.artists)))
+
+    def add(self, coord, height, artist=None):
+        """Store a new stem and return its slot."""
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.size == len(self.x):
+                self._grow()
+            slot = self.size
+            self.size += 1
+        self.x[slot] = coord[0]
+        self.y[slot] = coord[1]
+        self.height[slot] = height
+        self.alive[slot] = True
+        self.artists[slot] = artist
+        self.count += 1
+        return slot
+
+    def add_many(self, stems):
+        """Store every stem in `stems`, a dict of arrays keyed by STEM_FIELDS,
+        and return an array of their slots."""
+        count = len(stems['x'])
+        slots = np.empty(count, dtype=np.int64)
+        reused = min(count, len(self.free))
+        if reused:
+            slots[:reused] = self.free[-reused:]
+            del self.free[-reused:]
+        fresh = count - reused
+        while self.size + fresh > len(self.x):
+            self._grow()
+        slots[reused:] = np.arange(self.size, self.size + fresh)
+        self.size += fresh
+
+        for name in STEM_FIELDS:
+            getattr(self, name)[slots] = stems[name]
+        self.alive[slots] = True
+        self.count += count
+        return slots
+
+    def export(self, slots=None):
+        """Return a dict of copies of the STEM_FIELDS arrays for `slots`, by
+        default every live stem."""
+        if slots is None:
+            slots = self.live_slots()
+        return {name: getattr(self, name)[slots] for name in STEM_FIELDS}
+
+    def get_state(self):
+        """Return a dict of arrays from which set_state() can rebuild this
+        store exactly, slot for slot."""
+        store_state = {name: getattr(self, name)[:self.size].copy()
+                       for name in STEM_FIELDS + ('alive',)}
+        store_state['free'] = np.array(self.free, dtype=np.int64)
+        return store_state
+
+    def set_state(self, store_state):
+        """Replace the contents of this store with those from get_state()."""
+        size = len(store_state['alive'])
+        capacity = max(1024, size)
+        for name in STEM_FIELDS + ('alive',):
+            array = np.zeros(capacity, dtype=getattr(self, name).dtype)
+            array[:size] = store_state[name]
+            setattr(self, name, array)
+        self.artists = [None] * capacity
+        self.free = store_state['free'].tolist()
+        self.size = size
+        self.count = int(self.alive.sum())
+
+    def remove(self, slot):
+        """Mark the stem in `slot` dead and make the slot free for reuse."""
+        assert self.alive[slot]
+        self.alive[slot] = False
+        self.artists[slot] = None
+        self.free.append(slot)
+        self.count -= 1
+
+    def remove_many(self, slots):
+        """Remove every stem in the array `slots` at once."""
+        assert self.alive[slots].all()
+        self.alive[slots] = False
+        slots = slots.tolist()
+        for slot in slots:
+            self.artists[slot] = None
+        self.free.extend(slots)
+        self.count -= len(slots)
+
+    def coord(self, slot):
+        return (float(self.x[slot]), float(self.y[slot]))
+
+    def live_slots(self):
+        """Return an array of the slots of all live stems."""
+        return np.flatnonzero(self.alive[:self.size])
+
+    def highest(self, slots):
+        """Return the slot among `slots` with the greatest height.
+
+        Ties go to the lowest slot so the choice does not depend on the
+        order in which an index happens to return its results.
+        """
+        height = self.height
+        highest_slot = None
+        highest_height = None
+        for slot in slots:
+            slot_height = height[slot]
+            if highest_height is None or slot_height > highest_height or \
+                    (slot_height == highest_height and slot < highest_slot):
+                highest_height = slot_height
+                highest_slot = slot
+        return highest_slot
@@ -4,10 +4,49 @@
 import random
 import math
 
+import numpy as np
+
 
 DISK = 0
 SQUARE = 1
 
+# Width and height of the box around the plane unless the settings say
+# otherwise: the unit DISK, or the SQUARE from -1 to 1.
+DEFAULT_PLANE_SIZE = (2, 2)
+
+
+def plane_size(settings):
+    """Return the (width, height) of the box around the plane of `settings`,
+    which is a DISK of PLANE_RADIUS or a SQUARE of PLANE_WIDTH by
+    PLANE_HEIGHT (a rectangle, really)."""
+    shape = settings['PLANE_SHAPE']
+    if shape == DISK:
+        diameter = 2 * settings.get('PLANE_RADIUS', 1)
+        return (diameter, diameter)
+    elif shape == SQUARE:
+        return (settings.get('PLANE_WIDTH', 2), settings.get('PLANE_HEIGHT', 2))
+    else:
+        raise ValueError('Illegal value for `PLANE_SHAPE`.')
+
+
+def plane_bounds(settings):
+    """Return the (x_min, x_max, y_min, y_max) of the box around the plane of
+    `settings`, which is centred on the origin."""
+    width, height = plane_size(settings)
+    return (-width / 2, width / 2, -height / 2, height / 2)
+
+
+# How much further than the plane plots of it reach.
+PLOT_SCALE = 1.5
+
+
+def plot_limits(settings):
+    """Return the (x_min, x_max) and (y_min, y_max) to plot the plane of
+    `settings` within."""
+    x_min, x_max, y_min, y_max = plane_bounds(settings)
+    return ((PLOT_SCALE * x_min, PLOT_SCALE * x_max),
+            (PLOT_SCALE * y_min, PLOT_SCALE * y_max))
+
 
 def circle_circle_intersect(center_coord_a, center_coord_b, radius_a, radius_b):
     """Return True iff. the circle of radius `radius_a` centered on `center_coord_a`
@@ -19,14 +58,17 @@ def circle_circle_intersect(center_coord_a, center_coord_b, radius_a, radius_b):
     return distance_squared <= radius_sum * radius_sum
 
 
-def random_coord(shape):
-    """Return a random (x,y) coordinate inside  unit `shape`."""
+def random_coord(shape, size=DEFAULT_PLANE_SIZE):
+    """Return a random (x,y) coordinate inside `shape`, the box around which
+    is `size` wide and high."""
+    width, height = size
     if shape == DISK:
         theta = random_theta()
-        radial = math.sqrt(random_real())
+        radial = math.sqrt(random_real()) * (width / 2)
         return polar_to_cartesian(radial, theta)
     elif shape == SQUARE:
-        return (random_real() * 2 - 1, random_real() * 2 - 1)
+        return (random_real() * width - width / 2,
+                random_real() * height - height / 2)
     else:
         raise ValueError('Illegal value for `shape`.')
 
@@ -43,4 +85,144 @@ def random_theta():
 
 def polar_to_cartesian(radial, theta):
     """Convert a coordinate in (r, th) to (x, y)."""
-    return (radial * math.cos(theta), radial * math.sin(theta))
\ No newline at end of file
+    return (radial * math.cos(theta), radial * math.sin(theta))
+
+
+class RandomStream():
+    """Buffered source of the random numbers used by the simulation.
+
+    Drawing one scalar at a time from `random` is slow, so numbers are made
+    in large NumPy blocks and handed out one by one. Each kind of number
+    comes from its own generator spawned from `seed`, so a run is
+    reproducible and the numbers of one kind don't depend on how many of
+    another kind have been used. `generator` is free for bulk draws, and
+    `observer_generator` for draws made only to look at a run, which
+    mustn't change its course.
+    Coordinates are inside `shape`, the box around which is the (width,
+    height) `size`, centred on the origin.
+    """
+
+    def __init__(self, shape, seed=None, block_size=65536,
+                 size=DEFAULT_PLANE_SIZE):
+        self.shape = shape
+        self.width, self.height = size
+        self.block_size = block_size
+        seeds = np.random.SeedSequence(seed).spawn(5)
+        coord_seed, real_seed, direction_seed, bulk_seed, observer_seed = seeds
+        self.coord_generator = np.random.default_rng(coord_seed)
+        self.real_generator = np.random.default_rng(real_seed)
+        self.direction_generator = np.random.default_rng(direction_seed)
+        self.generator = np.random.default_rng(bulk_seed)
+        self.observer_generator = np.random.default_rng(observer_seed)
+        self._coords = []
+        self._coord_index = 0
+        self._reals = []
+        self._real_index = 0
+        self._directions = []
+        self._direction_index = 0
+        # Generator states from just before each buffer was filled, so that
+        # get_state() doesn't have to save the buffers themselves.
+        self._block_states = {}
+
+    def coords(self, count):
+        """Return a (count, 2) array of random coordinates inside the shape."""
+        if self.shape == DISK:
+            theta = self.coord_generator.random(count) * 2 * math.pi
+            radial = (np.sqrt(self.coord_generator.random(count))
+                      * (self.width / 2))
+            return np.column_stack((radial * np.cos(theta),
+                                    radial * np.sin(theta)))
+        elif self.shape == SQUARE:
+            size = np.array([self.width, self.height], dtype=np.float64)
+            return self.coord_generator.random((count, 2)) * size - size / 2
+        else:
+            raise ValueError('Illegal value for `shape`.')
+
+    def _fill_coords(self):
+        self._block_states['coord'] = self.coord_generator.bit_generator.state
+        self._coords = list(map(tuple, self.coords(self.block_size).tolist()))
+        self._coord_index = 0
+
+    def _fill_reals(self):
+        self._block_states['real'] = self.real_generator.bit_generator.state
+        self._reals = self.real_generator.random(self.block_size).tolist()
+        self._real_index = 0
+
+    def _fill_directions(self):
+        self._block_states['direction'] = (
+            self.direction_generator.bit_generator.state)
+        theta = self.direction_generator.random(self.block_size) * 2 * math.pi
+        self._directions = list(zip(np.cos(theta).tolist(),
+                                    np.sin(theta).tolist()))
+        self._direction_index = 0
+
+    def coord(self):
+        """Return a random (x,y) coordinate inside the shape."""
+        if self._coord_index == len(self._coords):
+            self._fill_coords()
+        coord = self._coords[self._coord_index]
+        self._coord_index += 1
+        return coord
+
+    def real(self):
+        """Return a random real number from 0 to 1."""
+        if self._real_index == len(self._reals):
+            self._fill_reals()
+        real = self._reals[self._real_index]
+        self._real_index += 1
+        return real
+
+    def direction(self):
+        """Return a random unit vector (cos(th), sin(th))."""
+        if self._direction_index == len(self._directions):
+            self._fill_directions()
+        direction = self._directions[self._direction_index]
+        self._direction_index += 1
+        return direction
+
+    def get_state(self):
+        """Return a JSON-safe dict from which set_state() can carry on the
+        stream exactly where it is now."""
+        return {
+            'generators': {
+                'coord': self.coord_generator.bit_generator.state,
+                'real': self.real_generator.bit_generator.state,
+                'direction': self.direction_generator.bit_generator.state,
+                'bulk': self.generator.bit_generator.state,
+                'observer': self.observer_generator.bit_generator.state
+            },
+            'block_states': self._block_states,
+            'block_size': self.block_size,
+            'indices': {
+                'coord': self._coord_index if self._coords else None,
+                'real': self._real_index if self._reals else None,
+                'direction': self._direction_index if self._directions else None
+            }
+        }
+
+    def set_state(self, stream_state):
+        """Carry on the stream from a state returned by get_state()."""
+        self.block_size = stream_state['block_size']
+        generators = {
+            'coord': self.coord_generator,
+            'real': self.real_generator,
+            'direction': self.direction_generator
+        }
+        fills = {'coord': self._fill_coords, 'real': self._fill_reals,
+                 'direction': self._fill_directions}
+
+        # Refill the buffers that were in use from where their generators
+        # were at the time, then skip what had already been handed out.
+        for kind, index in stream_state['indices'].items():
+            if index is not None:
+                generators[kind].bit_generator.state = (
+                    stream_state['block_states'][kind])
+                fills[kind]()
+                setattr(self, '_{}_index'.format(kind), index)
+        for kind, generator in generators.items():
+            generator.bit_generator.state = stream_state['generators'][kind]
+        self.generator.bit_generator.state = stream_state['generators']['bulk']
+        # Checkpoints from before there was an observer generator lack it.
+        if 'observer' in stream_state['generators']:
+            self.observer_generator.bit_generator.state = (
+                stream_state['generators']['observer'])
@@ -13,6 +13,9 @@ import matplotlib
 from mpl_toolkits.mplot3d import Axes3D
 import scipy.spatial
 
+import stem_io
+import util
+
 
 __author__ = "Jeremey Chizewer, Joseph Rubin"
 
@@ -27,10 +30,8 @@ def _main():
     
     filename = sys.argv[1]
 
-    with open(filename, 'r') as data_file:
-        data = json.loads(data_file.read())
-        settings = data['settings']
-        stems = data['stems']
+    data = stem_io.read_stems(filename, top_only=True)
+    settings = data['settings']
 
     # Find clusters.
     #coords = [state['points'][point_id]['coord'] for point_id in state['points']]
@@ -41,21 +42,8 @@ def _main():
 
     visualize_init(settings)
     
-    heights = []
-    for point in stems:
-        height = point['height']
-        heights.append(height)
-    max_height = max(heights)
-
-    stem_coords = []
-    stems_pruned = []
-    for point in stems:
-        height = point['height']
-        if height > max_height * 0.5:
-            stem_coords.append(point['coord'])
-            stems_pruned.append(point)
-
-    visualize_state_stems(stems_pruned, settings)
+    stem_coords = data['coords']
+    visualize_state_stems(stem_coords, data['heights'], settings)
 
     tri = scipy.spatial.Delaunay(stem_coords)
     boundary_simplices = [i for i, _ in enumerate(tri.simplices) if -1 in tri.neighbors[i]]
@@ -69,7 +57,8 @@ def _main():
 
 
 def alert_bad_usage_and_abort():
-    print('usage: {}: <filename.json>'.format(sys.argv[0]), file=sys.stderr)
+    print('usage: {}: <filename.json|filename.stems>'.format(sys.argv[0]),
+          file=sys.stderr)
     exit(1)
 
 
@@ -81,27 +70,24 @@ def visualize_init(settings):
     #ax = Axes3D(fig)
     fig.set_size_inches(12, 12)
     ax.axis('equal', adjustable='datalim')
-    ax.set(xlim=(-1.5, 1.5), ylim=(-1.5, 1.5))
+    xlim, ylim = util.plot_limits(settings)
+    ax.set(xlim=xlim, ylim=ylim)
     #plt.axis(xmin=0, xmax=1, ymin=0, ymax=1)
     #plt.axis('equal')
     #fname = sys.argv[1] + shape + str(count) + '-' + str(pstick1) + '-' + str(pmelt) + '-' + str(pstick2) + '-' + str(delta) + '-' + str(width) + '-' + str(numdrops) + '-' +  str(minStemLen) + '-' + str(hexa) + '.png'
     #ax.axis('equal')
-    if settings['PLANE_SHAPE'] == DISK: ax.add_artist(plt.Circle((0,0), radius=1, fill=False))
+    if settings['PLANE_SHAPE'] == DISK:
+        radius = util.plane_size(settings)[0] / 2
+        ax.add_artist(plt.Circle((0, 0), radius=radius, fill=False))
 
 
-def visualize_state_stems(stems, settings):
+def visualize_state_stems(coords, heights, settings):
     fig = plt.gcf()
     ax = plt.gca()
 
-    height_max = None
-    for point in stems:
-        height = point['height']
-        if height_max is None or height > height_max:
-            height_max = height
+    height_max = heights.max()
 
-    for point in stems:
-        coord = point['coord']
-        height = point['height']
+    for coord, height in zip(coords.tolist(), heights.tolist()):
         #point_id_bottom = stem[0]
         #point_bottom = points[str(point_id_bottom)]
         #coord_bottom = point_bottom['coord']